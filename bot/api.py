@@ -0,0 +1,87 @@
+import os
+import time
+import httpx
+
+SERVER_URL = os.getenv("SERVER_URL", "http://server:8000")
+# Сколько секунд держим ответ /status в кэше (0 - не кэшируем)
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", "30"))
+# Размер пула соединений к серверу
+POOL_SIZE = int(os.getenv("SERVER_POOL_SIZE", "50"))
+
+
+class ServerAPI:
+    """Клиент бэкенда: один httpx.AsyncClient на все хендлеры + кэш /status.
+
+    Создается в main.py и передается в хендлеры через Dispatcher (аргумент api).
+    Любая запись на сервер сбрасывает кэш этого юзера.
+    """
+
+    def __init__(self, base_url=SERVER_URL, status_ttl=STATUS_CACHE_TTL):
+        self.base_url = base_url
+        self.status_ttl = status_ttl
+        self._client = None
+        self._status_cache = {}  # telegram_id -> (истекает, ответ /status)
+
+    async def start(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=10.0,
+                limits=httpx.Limits(
+                    max_connections=POOL_SIZE,
+                    max_keepalive_connections=POOL_SIZE,
+                    keepalive_expiry=60,
+                ),
+            )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _post(self, path, telegram_id, **data):
+        self.invalidate(telegram_id)
+        try:
+            return await self._client.post(path, json={"telegram_id": telegram_id, **data})
+        finally:
+            # /status, прочитанный во время записи, мог положить в кэш старый профиль
+            self.invalidate(telegram_id)
+
+    def invalidate(self, telegram_id):
+        self._status_cache.pop(telegram_id, None)
+
+    async def status(self, telegram_id):
+        """Профиль юзера (dict) или None, если сервер его не знает"""
+        now = time.monotonic()
+        cached = self._status_cache.get(telegram_id)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        resp = await self._client.get(f"/status/{telegram_id}")
+        if resp.status_code != 200:
+            return None
+        data = resp.json()
+        if self.status_ttl <= 0:
+            return data
+        if len(self._status_cache) > 10000:
+            self._status_cache = {k: v for k, v in self._status_cache.items() if v[0] > now}
+        self._status_cache[telegram_id] = (now + self.status_ttl, data)
+        return data
+
+    async def register(self, telegram_id, display_name=None):
+        return await self._post("/register", telegram_id, display_name=display_name)
+
+    async def update_settings(self, telegram_id, **settings):
+        return await self._post("/update_settings", telegram_id, **settings)
+
+    async def add_contact(self, telegram_id, info, chat_id=None):
+        return await self._post("/contacts/add", telegram_id, info=info, chat_id=chat_id)
+
+    async def clear_contacts(self, telegram_id):
+        return await self._post("/clear_contacts", telegram_id)
+
+    async def checkin(self, telegram_id):
+        return await self._post("/checkin", telegram_id)
+
+    async def sos(self, telegram_id):
+        return await self._post("/sos_manual", telegram_id)
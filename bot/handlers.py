@@ -1,5 +1,3 @@
-import os
-import httpx
 from aiogram import Router, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
@@ -7,8 +5,9 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from datetime import datetime
 
+from api import ServerAPI
+
 router = Router()
-SERVER_URL = os.getenv("SERVER_URL", "http://server:8000")
 MENU_BUTTONS = ["📝 Записка", "👥 Контакты", "⏱ Интервал", "💤 Режим сна", "📊 Статус", "🆘 SOS"]
 
 class Form(StatesGroup):
@@ -25,6 +24,10 @@ def main_menu():
     ]
     return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
 
+# Как юзера увидят контакты в SOS: "Иван Петров (@ivan)"
+def display_name(user: types.User):
+    return f"{user.full_name} (@{user.username})" if user.username else user.full_name
+
 async def check_interruption(message: types.Message, state: FSMContext):
     if message.text in MENU_BUTTONS:
         await state.clear()
@@ -32,91 +35,104 @@ async def check_interruption(message: types.Message, state: FSMContext):
     return False
 
 @router.message(Command("start"))
-async def cmd_start(message: types.Message):
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{SERVER_URL}/register", json={"telegram_id": message.from_user.id})
+async def cmd_start(message: types.Message, api: ServerAPI):
+    await api.register(message.from_user.id, display_name(message.from_user))
     await message.answer("👋 Система мониторинга активна!", reply_markup=main_menu())
 
 @router.message(F.text == "📊 Статус")
-async def cmd_status(message: types.Message):
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{SERVER_URL}/status/{message.from_user.id}")
-        if resp.status_code == 200:
-            d = resp.json()
-            contacts_str = "\n".join([f"• {c['info']}" for c in d['contacts']]) if d['contacts'] else "Пусто"
-            text = (
-                f"📋 **Твой профиль:**\n\n"
-                f"⏱ Интервал: {d['check_interval']} ч.\n"
-                f"💤 Сон: {d['dnd']}\n"
-                f"📝 Записка: {d['death_note']}\n\n"
-                f"👥 **Контакты для SOS:**\n{contacts_str}"
-            )
-            await message.answer(text, parse_mode="Markdown")
+async def cmd_status(message: types.Message, api: ServerAPI):
+    d = await api.status(message.from_user.id)
+    if d:
+        # 📨 - контакт из Telegram, ему бот сам отправит SOS
+        contacts_str = "\n".join(
+            [f"• {c['info']}{' 📨' if c.get('chat_id') else ''}" for c in d['contacts']]
+        ) if d['contacts'] else "Пусто"
+        text = (
+            f"📋 **Твой профиль:**\n\n"
+            f"⏱ Интервал: {d['check_interval']} ч.\n"
+            f"💤 Сон: {d['dnd']}\n"
+            f"📝 Записка: {d['death_note']}\n\n"
+            f"👥 **Контакты для SOS:**\n{contacts_str}"
+        )
+        await message.answer(text, parse_mode="Markdown")
 
 @router.message(F.text == "👥 Контакты")
 async def contact_menu(message: types.Message, state: FSMContext):
     inline_kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Очистить все контакты", callback_data="clear_contacts")]
     ])
-    await message.answer("Отправь имя и телефон (напр. Мама +7999...), чтобы добавить в список.\nИли нажми кнопку ниже, чтобы удалить всех:", reply_markup=inline_kb)
+    await message.answer(
+        "Отправь имя и телефон (напр. Мама +7999...), чтобы добавить в список.\n"
+        "Или поделись контактом из Telegram (📎 → Контакт) - при SOS бот сам напишет ему, "
+        "если он хоть раз открыл бота и нажал /start (первым Telegram писать не дает).\n"
+        "Чтобы удалить всех, нажми кнопку ниже:",
+        reply_markup=inline_kb,
+    )
     await state.set_state(Form.waiting_for_contact)
 
 @router.callback_query(F.data == "clear_contacts")
-async def process_clear_contacts(callback: types.CallbackQuery, state: FSMContext):
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{SERVER_URL}/clear_contacts", json={"telegram_id": callback.from_user.id})
+async def process_clear_contacts(callback: types.CallbackQuery, state: FSMContext, api: ServerAPI):
+    await api.clear_contacts(callback.from_user.id)
     await callback.message.edit_text("✅ Список контактов очищен.")
     await state.clear()
 
 @router.message(Form.waiting_for_contact)
-async def save_contact(message: types.Message, state: FSMContext):
-    if await check_interruption(message, state): return await handle_menu_buttons(message, state)
-    async with httpx.AsyncClient() as client:
-        res = await client.get(f"{SERVER_URL}/status/{message.from_user.id}")
-        current_contacts = res.json().get('contacts', [])
-        current_contacts.append({"info": message.text})
-        await client.post(f"{SERVER_URL}/update_settings", json={"telegram_id": message.from_user.id, "contacts": current_contacts})
+async def save_contact(message: types.Message, state: FSMContext, api: ServerAPI):
+    if await check_interruption(message, state): return await handle_menu_buttons(message, state, api)
+    if message.contact:
+        # Контакт из Telegram: user_id есть, только если у человека есть Telegram
+        c = message.contact
+        info = " ".join(p for p in (c.first_name, c.last_name, c.phone_number) if p)
+        await api.add_contact(message.from_user.id, info, chat_id=c.user_id)
+        if c.user_id:
+            hint = "Попроси его открыть бота и нажать /start, иначе сообщение о SOS до него не дойдет."
+        else:
+            hint = "У него нет Telegram: при SOS свяжись с ним сам."
+        await message.answer(f"✅ Контакт добавлен!\n{hint}", reply_markup=main_menu())
+        return await state.clear()
+    elif message.text:
+        await api.add_contact(message.from_user.id, message.text)
+    else:
+        return await message.answer("❌ Отправь текст или контакт.")
     await message.answer(f"✅ Контакт добавлен!", reply_markup=main_menu())
     await state.clear()
 
 @router.message(F.text == "📝 Записка")
-async def edit_note(message: types.Message, state: FSMContext):
-    res = await httpx.AsyncClient().get(f"{SERVER_URL}/status/{message.from_user.id}")
-    current = res.json().get('death_note')
+async def edit_note(message: types.Message, state: FSMContext, api: ServerAPI):
+    status = await api.status(message.from_user.id) or {}
+    current = status.get('death_note')
     await message.answer(f"Текущая записка: {current}\n\nВведите новый текст:")
     await state.set_state(Form.waiting_for_note)
 
 @router.message(F.text == "💤 Режим сна")
-async def set_dnd(message: types.Message, state: FSMContext):
-    res = await httpx.AsyncClient().get(f"{SERVER_URL}/status/{message.from_user.id}")
-    current = res.json().get('dnd')
+async def set_dnd(message: types.Message, state: FSMContext, api: ServerAPI):
+    status = await api.status(message.from_user.id) or {}
+    current = status.get('dnd')
     await message.answer(f"Текущий режим сна: {current}\n\nВведите новый (ЧЧ:ММ-ЧЧ:ММ):")
     await state.set_state(Form.waiting_for_dnd)
     
 @router.message(Form.waiting_for_note)
-async def save_note(message: types.Message, state: FSMContext):
-    if await check_interruption(message, state): return await handle_menu_buttons(message, state)
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{SERVER_URL}/update_settings", json={"telegram_id": message.from_user.id, "death_note": message.text})
+async def save_note(message: types.Message, state: FSMContext, api: ServerAPI):
+    if await check_interruption(message, state): return await handle_menu_buttons(message, state, api)
+    await api.update_settings(message.from_user.id, death_note=message.text)
     await message.answer("✅ Сохранено!", reply_markup=main_menu()); await state.clear()
 
 @router.message(Form.waiting_for_interval)
-async def save_interval(message: types.Message, state: FSMContext):
-    if await check_interruption(message, state): return await handle_menu_buttons(message, state)
+async def save_interval(message: types.Message, state: FSMContext, api: ServerAPI):
+    if await check_interruption(message, state): return await handle_menu_buttons(message, state, api)
     try:
         val = float(message.text.replace(",", "."))
         if val <= 0: raise ValueError
     except ValueError:
         return await message.answer("❌ Ошибка! Введите число.")
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{SERVER_URL}/update_settings", json={"telegram_id": message.from_user.id, "check_interval": val})
+    await api.update_settings(message.from_user.id, check_interval=val)
     await message.answer(f"✅ Интервал обновлен: {val} ч.", reply_markup=main_menu())
     await state.clear()
 
 @router.message(Form.waiting_for_dnd)
-async def save_dnd(message: types.Message, state: FSMContext):
+async def save_dnd(message: types.Message, state: FSMContext, api: ServerAPI):
     if await check_interruption(message, state): 
-        return await handle_menu_buttons(message, state)
+        return await handle_menu_buttons(message, state, api)
         
     # 1. Проверяем наличие дефиса
     if "-" not in message.text:
@@ -132,15 +148,11 @@ async def save_dnd(message: types.Message, state: FSMContext):
         datetime.strptime(end_str.strip(), time_format)
         
         # 3. Если проверки прошли, отправляем на сервер
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                f"{SERVER_URL}/update_settings", 
-                json={
-                    "telegram_id": message.from_user.id, 
-                    "dnd_start": start_str.strip(), 
-                    "dnd_end": end_str.strip()
-                }
-            )
+        await api.update_settings(
+            message.from_user.id,
+            dnd_start=start_str.strip(),
+            dnd_end=end_str.strip()
+        )
         
         await message.answer(f"✅ Режим сна установлен: с {start_str} до {end_str}", reply_markup=main_menu())
         await state.clear()
@@ -152,16 +164,16 @@ async def save_dnd(message: types.Message, state: FSMContext):
         await message.answer("❌ Произошла ошибка при сохранении. Попробуйте еще раз.")
 
 @router.message(F.text == "🆘 SOS")
-async def manual_sos(message: types.Message):
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{SERVER_URL}/sos_manual", json={"telegram_id": message.from_user.id})
+async def manual_sos(message: types.Message, api: ServerAPI):
+    await api.sos(message.from_user.id)
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ ОТБОЙ (Я в порядке)", callback_data="i_am_ok")]
     ])
     
     await message.answer(
-        "🚨 **ТРЕВОГА АКТИВИРОВАНА!**\nВаша записка и координаты готовы к отправке.\n\n"
+        "🚨 **ТРЕВОГА АКТИВИРОВАНА!**\nКонтактам из Telegram (📨) бот отправит записку, "
+        "о недоставленных сообщит. Остальным сообщите сами.\n\n"
         "Чтобы возобновить мониторинг, нажмите кнопку ниже:",
         reply_markup=kb,
         parse_mode="Markdown"
@@ -173,17 +185,16 @@ async def set_interval(message: types.Message, state: FSMContext):
     await state.set_state(Form.waiting_for_interval)
 
 @router.callback_query(F.data == "i_am_ok")
-async def process_checkin(callback: types.CallbackQuery):
-    async with httpx.AsyncClient() as client:
-        await client.post(f"{SERVER_URL}/checkin", json={"telegram_id": callback.from_user.id})
+async def process_checkin(callback: types.CallbackQuery, api: ServerAPI):
+    await api.checkin(callback.from_user.id)
     await callback.message.edit_text("✅ Таймер сброшен! Я спокоен.", reply_markup=None)
     await callback.answer("Статус обновлен")
 
-async def handle_menu_buttons(message: types.Message, state: FSMContext):
+async def handle_menu_buttons(message: types.Message, state: FSMContext, api: ServerAPI):
     m = message.text
-    if m == "📝 Записка": await edit_note(message, state)
+    if m == "📝 Записка": await edit_note(message, state, api)
     elif m == "👥 Контакты": await contact_menu(message, state)
     elif m == "⏱ Интервал": await set_interval(message, state)
-    elif m == "💤 Режим сна": await set_dnd(message, state)
-    elif m == "📊 Статус": await cmd_status(message)
-    elif m == "🆘 SOS": await manual_sos(message)
\ No newline at end of file
+    elif m == "💤 Режим сна": await set_dnd(message, state, api)
+    elif m == "📊 Статус": await cmd_status(message, api)
+    elif m == "🆘 SOS": await manual_sos(message, api)
\ No newline at end of file
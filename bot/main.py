@@ -1,26 +1,105 @@
 import asyncio
 import os
 import logging
-from aiogram import Bot, Dispatcher
+from aiogram import Bot, Dispatcher, BaseMiddleware
+from aiogram.fsm.storage.memory import MemoryStorage
 from dotenv import load_dotenv
 
 # Импортируем наш роутер из соседнего файла
 from handlers import router
+from api import ServerAPI, STATUS_CACHE_TTL
 
 load_dotenv()
 
+# Режим приема апдейтов: "polling" (одна реплика) или "webhook" (сколько угодно реплик за балансировщиком)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Сколько апдейтов обрабатываем одновременно в одном процессе
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "100"))
+# Где хранить состояния FSM (Form): "memory" - в процессе, "redis" - общее хранилище для всех реплик
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+
+# Настройки вебхука
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+
+class ConcurrencyLimit(BaseMiddleware):
+    """Ограничивает число апдейтов, которые обрабатываются одновременно.
+    Всплеск (все жмут "Я В ПОРЯДКЕ" после массовой тревоги) идет параллельно,
+    но не больше MAX_CONCURRENT_UPDATES за раз"""
+
+    def __init__(self, limit):
+        self._sem = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self._sem:
+            return await handler(event, data)
+
+
+def build_storage():
+    if FSM_STORAGE == "redis":
+        # Импорт тут: redis нужен только при нескольких репликах
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL)
+    return MemoryStorage()
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    async def set_webhook(bot: Bot):
+        # Каждая реплика ставит один и тот же адрес - это идемпотентно
+        await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+
+    async def health(request):
+        return web.json_response({"status": "ok"})
+
+    dp.startup.register(set_webhook)
+    app = web.Application()
+    app.router.add_get("/health", health)
+    # handle_in_background: Telegram сразу получает 200, апдейт обрабатывается задачей
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    print(f"🤖 Бот запущен (вебхук {WEBHOOK_PATH}, порт {WEBHOOK_PORT})...")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 async def main():
     # Настройка логов
     logging.basicConfig(level=logging.INFO)
-    
+
     bot = Bot(token=os.getenv("BOT_TOKEN"))
-    dp = Dispatcher()
+    # Один клиент бэкенда на весь бот, хендлеры получают его аргументом api.
+    # С вебхуком реплик несколько, а кэш /status у каждой свой: запись через одну
+    # реплику не сбросит его у другой. Поэтому там кэшируем только на сервере
+    api = ServerAPI(status_ttl=0 if BOT_MODE == "webhook" else STATUS_CACHE_TTL)
+    dp = Dispatcher(storage=build_storage(), api=api)
+    dp.startup.register(api.start)
+    dp.shutdown.register(api.close)
+    dp.update.outer_middleware(ConcurrencyLimit(MAX_CONCURRENT_UPDATES))
 
     # Подключаем обработчики из handlers.py
     dp.include_router(router)
 
-    print("🤖 Бот запущен (через handlers.py)...")
-    await dp.start_polling(bot)
+    if BOT_MODE == "webhook":
+        await run_webhook(bot, dp)
+    else:
+        print("🤖 Бот запущен (через handlers.py)...")
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
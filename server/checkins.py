@@ -0,0 +1,165 @@
+import os
+import asyncio
+import logging
+from sqlalchemy import select, update, case, literal
+from sqlalchemy.orm import aliased
+from sqlalchemy import DateTime
+
+from database import engine, User, SosOutbox, any_of, hours_interval
+from escalation import PENDING, CANCELLED
+from metrics import Counter, Gauge
+
+# Буфер чекинов: 0 - выключен (каждый /checkin пишет в базу сразу),
+# N - чекины копятся в памяти и пишутся одним UPDATE раз в N мс
+CHECKIN_BUFFER_MS = int(os.getenv("CHECKIN_BUFFER_MS", "0"))
+# Сколько юзеров в буфере вызывает сброс, не дожидаясь таймера
+CHECKIN_BUFFER_MAX = int(os.getenv("CHECKIN_BUFFER_MAX", "5000"))
+log = logging.getLogger("checkins")
+
+_before = aliased(User)
+
+
+async def checkin_users(db, telegram_ids, now):
+    """Отмечает юзеров одним UPDATE ... RETURNING, без предварительного SELECT.
+    Тем же запросом (CTE) отменяет еще не отправленные контактам сообщения о SOS:
+    юзер в порядке, будить контактов уже незачем.
+    Возвращает строки (telegram_id, next_due_at, prev_status) только для найденных.
+    Коммит - на вызывающем"""
+    cancel_sos = (
+        update(SosOutbox)
+        .where(any_of(SosOutbox.telegram_id, telegram_ids), SosOutbox.status == PENDING)
+        .values(status=CANCELLED)
+        .returning(SosOutbox.id)
+        .cte("cancel_sos")
+    )
+    # Подзапрос в RETURNING видит строку до обновления - так узнаем старый статус
+    prev_status = (
+        select(_before.alert_status)
+        .where(_before.telegram_id == User.telegram_id)
+        .correlate(User)
+        .scalar_subquery()
+    )
+    stmt = (
+        update(User)
+        .where(any_of(User.telegram_id, telegram_ids))
+        .values(
+            last_checkin=now,
+            alert_status=0,
+            next_due_at=case(
+                (User.is_active == True, literal(now, DateTime) + hours_interval(User.check_interval)),
+                else_=None,
+            ),
+        )
+        .returning(User.telegram_id, User.next_due_at, prev_status.label("prev_status"))
+        .add_cte(cancel_sos)
+        .execution_options(synchronize_session=False)
+    )
+    return (await db.execute(stmt)).all()
+
+
+BUFFERED = Counter("checkin_buffer_total", "Чекины через буфер: принятые и записанные в базу", ["result"])
+
+
+class CheckinBuffer:
+    """Копит чекины в памяти и пишет их пачкой (write-behind).
+
+    Повторные нажатия одного юзера схлопываются в одну строку UPDATE.
+    Пока чекин лежит в буфере или пишется, планировщик этого процесса
+    пропускает юзера (pending_ids), так что ложных тревог не будет.
+    Дедлайн считается от самого раннего чекина пачки - сдвиг не больше
+    CHECKIN_BUFFER_MS и только в сторону более раннего срабатывания.
+    """
+
+    def __init__(self, interval_ms=CHECKIN_BUFFER_MS, max_pending=CHECKIN_BUFFER_MAX):
+        self.interval = interval_ms / 1000
+        self.max_pending = max_pending
+        self._pending = {}      # telegram_id -> время первого чекина в пачке
+        self._inflight = set()  # уже забраны из буфера, но еще не закоммичены
+        self._flushed = asyncio.Event()  # выставляется, когда текущая пачка записана (или упала)
+        self._wakeup = asyncio.Event()
+        self._on_flush = None
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, telegram_id, now):
+        self._pending.setdefault(telegram_id, now)
+        BUFFERED.inc("accepted")
+        if len(self._pending) >= self.max_pending:
+            self._wakeup.set()
+
+    async def discard(self, telegram_id):
+        """Отменяет еще не записанный чекин (например, юзер сразу нажал SOS).
+        Если чекин юзера уже пишется, ждет конца записи пачки: иначе она сбросила бы
+        статус, выставленный вызывающим сразу после discard"""
+        self._pending.pop(telegram_id, None)
+        while telegram_id in self._inflight:
+            await self._flushed.wait()
+            # Упавшая пачка возвращается в буфер
+            self._pending.pop(telegram_id, None)
+
+    def pending_ids(self):
+        if not self._pending and not self._inflight:
+            return ()
+        return self._pending.keys() | self._inflight
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self._inflight = set(batch)
+        self._flushed = asyncio.Event()
+        try:
+            async with engine.connect() as db:
+                rows = await checkin_users(db, list(batch), min(batch.values()))
+                await db.commit()
+        except Exception as e:
+            log.error("❌ Ошибка записи чекинов: %s", e)
+            # Возвращаем в буфер, более свежие чекины не затираем
+            for tid, at in batch.items():
+                self._pending.setdefault(tid, at)
+            return
+        finally:
+            self._inflight = set()
+            self._flushed.set()
+        BUFFERED.inc("flushed", amount=len(rows))
+        if len(rows) < len(batch):
+            log.debug("Чекины для несуществующих юзеров отброшены: %s", len(batch) - len(rows))
+        if self._on_flush is not None:
+            self._on_flush(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self, on_flush):
+        """on_flush(rows) вызывается после каждой записанной пачки"""
+        self._on_flush = on_flush
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+            log.info("✅ Буфер чекинов: сброс раз в %s мс", int(self.interval * 1000))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Последняя пачка - до остановки планировщика
+        await self.flush()
+
+
+checkin_buffer = CheckinBuffer()
+Gauge("checkin_buffer_pending", "Чекины в буфере, еще не записанные в базу", lambda: len(checkin_buffer))
@@ -1,19 +1,66 @@
 import os
+import hashlib
+from uuid import uuid4
+import logging
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import BigInteger, Integer, String, DateTime, JSON, Boolean, Float
-from datetime import datetime
+from sqlalchemy import BigInteger, Integer, SmallInteger, String, DateTime, Boolean, Float, Index, Interval, ForeignKey
+from sqlalchemy import UniqueConstraint
+from sqlalchemy import func, inspect, text, any_, bindparam, ARRAY
+from datetime import datetime, timedelta
 
 # Настройки подключения
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+asyncpg://user:password@db/lonely_db")
+# "version" - на старте сверяем версию схемы и пропускаем create_all и миграции,
+# если база уже актуальна; "full" - проверять все таблицы и индексы каждый раз
+SCHEMA_CHECK = os.getenv("SCHEMA_CHECK", "version")
 
-engine = create_async_engine(DATABASE_URL, 
-                             echo=False,
-                             pool_size=20,
-                             max_overflow=10
-                             ) # echo=False, чтобы не мусорить в логах
+# Пул соединений на процесс: под нагрузкой держим DB_POOL_SIZE, в пике - еще DB_MAX_OVERFLOW.
+# Сумма по всем воркерам и репликам не должна превышать max_connections Postgres
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Сколько запрос ждет свободного соединения, прежде чем упасть с ошибкой
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Пересоздавать соединения старше N секунд (-1 - никогда): их рвут балансировщики и файрволы
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# SELECT 1 при каждой выдаче из пула: переживает рестарт базы, но стоит запроса
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") == "1"
+# Подготовленные asyncpg-запросы на соединение: повторный запрос не разбирается и не
+# планируется заново
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500"))
+# За pgbouncer в режиме transaction соседние транзакции попадают на разные серверные
+# соединения, и именованный подготовленный запрос может столкнуться с чужим.
+# DB_PGBOUNCER=1 выключает кэши SQLAlchemy и asyncpg и дает запросам уникальные имена
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"
+
+def _connect_args():
+    if DB_PGBOUNCER:
+        return {
+            "prepared_statement_cache_size": 0,
+            "statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        }
+    return {"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,  # чтобы не мусорить в логах
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args=_connect_args(),
+)
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+log = logging.getLogger("database")
+
+# Интервал проверки по умолчанию (в часах)
+DEFAULT_CHECK_INTERVAL = 24.0
+# Сколько по умолчанию даем на ответ после предупреждения (у юзера - grace_seconds)
+WARNING_GRACE = timedelta(seconds=60)
+
 class Base(DeclarativeBase):
     pass
 
@@ -28,14 +75,26 @@ class User(Base):
     is_active: Mapped[bool] = mapped_column(Boolean, default=True)
     
     # Интервал проверки (в часах)
-    check_interval: Mapped[float] = mapped_column(Float, default=24.0)
+    check_interval: Mapped[float] = mapped_column(Float, default=DEFAULT_CHECK_INTERVAL)
     
-    # Часовой пояс (храним просто строку, например "Europe/Moscow" или смещение "+3")
+    # Сколько секунд ждем ответа на предупреждение до SOS
+    grace_seconds: Mapped[int] = mapped_column(Integer, default=int(WARNING_GRACE.total_seconds()))
+    # Сколько напоминаний слать за это время (равномерно, между предупреждением и SOS)
+    reminders: Mapped[int] = mapped_column(SmallInteger, default=0)
+
+    # Как показать юзера контактам в SOS ("Иван Петров (@ivan)"), приходит из бота в /register
+    display_name: Mapped[str | None] = mapped_column(String, nullable=True)
+
+    # Часовой пояс (имя IANA, например "Europe/Moscow"; смещение "+3" сохраняется как "Etc/GMT-3")
     timezone: Mapped[str] = mapped_column(String, default="UTC")
 
     # Время "Не беспокоить" (строки "23:00", "08:00")
     dnd_start: Mapped[str | None] = mapped_column(String, nullable=True)
     dnd_end: Mapped[str | None] = mapped_column(String, nullable=True)
+    # Те же границы, разобранные один раз при сохранении: минута суток (0..1439)
+    # в поясе юзера. По ним планировщик считает DND целыми числами
+    dnd_start_min: Mapped[int | None] = mapped_column(SmallInteger, nullable=True)
+    dnd_end_min: Mapped[int | None] = mapped_column(SmallInteger, nullable=True)
 
     # СОСТОЯНИЕ
     # Когда последний раз отмечался
@@ -44,33 +103,257 @@ class User(Base):
     # Статус тревоги (0 - ок, 1 - ждем ответа, 2 - SOS отправлен)
     alert_status: Mapped[int] = mapped_column(Integer, default=0)
 
+    # Дедлайн следующего действия планировщика (UTC):
+    # статус 0 - когда слать предупреждение, статус 1 - следующее напоминание или SOS.
+    # NULL - планировщику делать нечего (SOS уже отправлен или мониторинг выключен)
+    next_due_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    # Этапы текущей эскалации: когда предупредили и когда уйдет SOS
+    # (warned_at + grace_seconds), сколько напоминаний уже отправлено
+    warned_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    escalate_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    reminders_sent: Mapped[int] = mapped_column(SmallInteger, default=0)
+
     # ДАННЫЕ ДЛЯ ЧП 
-    # Список контактов: [{"name": "Мама", "phone": "+7900..."}]
-    contacts: Mapped[list] = mapped_column(JSON, default=[])
-    
-    # Предсмертная записка
-    death_note: Mapped[str | None] = mapped_column(String, nullable=True)
+    # Контакты и записка лежат в отдельных таблицах (contacts, death_notes):
+    # строка users остается узкой, а чекин и тик планировщика не таскают
+    # и не переписывают большие поля
+
+    __table_args__ = (
+        # Частичный индекс: в него попадают только юзеры, которых надо проверять,
+        # поэтому тик планировщика читает только "просроченные" строки
+        Index("ix_users_next_due_at", "next_due_at", postgresql_where=text("next_due_at IS NOT NULL")),
+        # Тревоги в процессе - для восстановления после рестарта
+        Index("ix_users_alert_status", "alert_status", postgresql_where=text("alert_status <> 0")),
+    )
+
+class Contact(Base):
+    """Контакт для ЧП. Отдельная таблица: добавление/удаление - одна строка,
+    а не перезапись всего списка"""
+    __tablename__ = "contacts"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    telegram_id: Mapped[int] = mapped_column(
+        BigInteger, ForeignKey("users.telegram_id", ondelete="CASCADE"), index=True
+    )
+    # Как ввел юзер, например "Мама +7999..."
+    info: Mapped[str] = mapped_column(String)
+    # Telegram контакта (если юзер поделился контактом из Telegram) - туда уходит SOS
+    chat_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class DeathNote(Base):
+    """Предсмертная записка. Отдельно от users: пишется редко, читается только в /status"""
+    __tablename__ = "death_notes"
+
+    telegram_id: Mapped[int] = mapped_column(
+        BigInteger, ForeignKey("users.telegram_id", ondelete="CASCADE"), primary_key=True
+    )
+    note: Mapped[str] = mapped_column(String)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class SosOutbox(Base):
+    """Исходящие SOS контактам (transactional outbox).
+
+    Строки пишутся в той же транзакции, что и перевод юзера в SOS, поэтому
+    тревога не теряется при падении процесса. Рассылают их воркеры
+    escalation.py. (telegram_id, sos_at, contact_id) - ключ идемпотентности:
+    одна тревога - одно сообщение каждому контакту.
+    """
+    __tablename__ = "sos_outbox"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    telegram_id: Mapped[int] = mapped_column(BigInteger)
+    contact_id: Mapped[int] = mapped_column(Integer)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    # Имя юзера и записка на момент тревоги
+    name: Mapped[str | None] = mapped_column(String, nullable=True)
+    note: Mapped[str | None] = mapped_column(String, nullable=True)
+    # Когда поднята тревога (от него считаем задержку доставки)
+    sos_at: Mapped[datetime] = mapped_column(DateTime)
+
+    # 0 - ждет отправки, 1 - доставлено, 2 - не доставлено (попытки кончились или Telegram отказал),
+    # 3 - отменено: юзер отметился раньше, чем сообщение ушло
+    status: Mapped[int] = mapped_column(SmallInteger, default=0)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    # Когда можно брать в работу: время повтора или конец аренды воркером
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime)
+    sent_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("telegram_id", "sos_at", "contact_id", name="uq_sos_outbox_event"),
+        Index("ix_sos_outbox_pending", "next_attempt_at", postgresql_where=text("status = 0")),
+    )
+
+class SchemaVersion(Base):
+    """Отпечаток схемы, до которой докатана база (см. schema_fingerprint)"""
+    __tablename__ = "schema_version"
+
+    version: Mapped[str] = mapped_column(String, primary_key=True)
+    applied_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+def seconds_interval(seconds):
+    """Переводит секунды (число или колонку) в интервал Postgres"""
+    return func.make_interval(0, 0, 0, 0, 0, 0, seconds, type_=Interval)
+
+def hours_interval(hours):
+    """Переводит часы (float или колонку) в интервал Postgres"""
+    return seconds_interval(hours * 3600)
+
+def any_of(column, values):
+    """column = ANY(:values) - один параметр-массив вместо IN (...) на тысячи параметров"""
+    return column == any_(bindparam("ids", list(values), type_=ARRAY(column.type), unique=True))
+
+# Колонки, добавленные после первого релиза. create_all не трогает уже
+# существующие таблицы, поэтому докатываем их руками.
+# (таблица, колонка, тип, SQL для заполнения старых строк)
+MIGRATIONS = [
+    ("users", "next_due_at", "TIMESTAMP WITHOUT TIME ZONE",
+     """UPDATE users SET next_due_at = CASE
+            WHEN alert_status = 0 THEN last_checkin + make_interval(secs => check_interval * 3600)
+            ELSE last_checkin + interval '60 seconds'
+        END
+        WHERE is_active AND alert_status IN (0, 1)"""),
+    ("users", "dnd_start_min", "SMALLINT",
+     """UPDATE users SET dnd_start_min = split_part(dnd_start, ':', 1)::int * 60 + split_part(dnd_start, ':', 2)::int
+        WHERE dnd_start ~ '^[0-9]{1,2}:[0-9]{2}$'"""),
+    ("users", "dnd_end_min", "SMALLINT",
+     """UPDATE users SET dnd_end_min = split_part(dnd_end, ':', 1)::int * 60 + split_part(dnd_end, ':', 2)::int
+        WHERE dnd_end ~ '^[0-9]{1,2}:[0-9]{2}$'"""),
+    ("users", "grace_seconds", "INTEGER NOT NULL DEFAULT 60", None),
+    ("users", "reminders", "SMALLINT NOT NULL DEFAULT 0", None),
+    ("users", "reminders_sent", "SMALLINT NOT NULL DEFAULT 0", None),
+    # Раньше предупреждение перезаписывало last_checkin своим временем
+    ("users", "warned_at", "TIMESTAMP WITHOUT TIME ZONE",
+     "UPDATE users SET warned_at = last_checkin WHERE alert_status = 1"),
+    ("users", "escalate_at", "TIMESTAMP WITHOUT TIME ZONE",
+     "UPDATE users SET escalate_at = coalesce(next_due_at, last_checkin + interval '60 seconds') WHERE alert_status = 1"),
+    ("users", "display_name", "VARCHAR", None),
+]
+
+# Новые таблицы, которые надо заполнить из старой схемы.
+# (новая таблица, (старая таблица, старая колонка), список SQL)
+TABLE_MIGRATIONS = [
+    ("contacts", ("users", "contacts"), [
+        """INSERT INTO contacts (telegram_id, info, created_at)
+           SELECT u.telegram_id, c->>'info', now() AT TIME ZONE 'UTC'
+           FROM users u, json_array_elements(u.contacts) AS c
+           WHERE json_typeof(u.contacts) = 'array' AND c->>'info' IS NOT NULL""",
+        # Старая колонка больше не пишется, но остается в базе для отката
+        "ALTER TABLE users ALTER COLUMN contacts DROP NOT NULL",
+    ]),
+    # Старая колонка остается как есть, тоже для отката
+    ("death_notes", ("users", "death_note"), [
+        """INSERT INTO death_notes (telegram_id, note, updated_at)
+           SELECT telegram_id, death_note, now() AT TIME ZONE 'UTC'
+           FROM users WHERE death_note IS NOT NULL""",
+    ]),
+]
+
+def _existing_tables(sync_conn):
+    return set(inspect(sync_conn).get_table_names())
+
+def _existing_columns(sync_conn, table):
+    return {col["name"] for col in inspect(sync_conn).get_columns(table)}
+
+def _create_indexes(sync_conn):
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+async def upgrade_schema(conn, tables_before):
+    """Добавляет недостающие колонки и индексы в старую базу.
+    tables_before - таблицы, которые были в базе до create_all"""
+    for table, (old_table, old_column), statements in TABLE_MIGRATIONS:
+        if table in tables_before or old_table not in tables_before:
+            continue
+        if old_column not in await conn.run_sync(_existing_columns, old_table):
+            continue
+        log.info("🛠 Миграция: %s.%s -> %s", old_table, old_column, table)
+        for sql in statements:
+            await conn.execute(text(sql))
+    for table, column, ddl, backfill in MIGRATIONS:
+        columns = await conn.run_sync(_existing_columns, table)
+        if column in columns:
+            continue
+        log.info("🛠 Миграция: %s.%s", table, column)
+        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        if backfill:
+            await conn.execute(text(backfill))
+    await conn.run_sync(_create_indexes)
+
+# Ключ advisory-лока: миграции катит одна реплика, остальные ждут
+SCHEMA_LOCK_KEY = 71000
+
+def schema_fingerprint():
+    """Хэш DDL всех моделей и списков миграций. Меняется при любой правке схемы,
+    так что номер версии не надо вести руками"""
+    from sqlalchemy.dialects import postgresql
+    from sqlalchemy.schema import CreateTable, CreateIndex
+    dialect = postgresql.dialect()
+    parts = []
+    for table in Base.metadata.sorted_tables:
+        parts.append(str(CreateTable(table).compile(dialect=dialect)))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            parts.append(str(CreateIndex(index).compile(dialect=dialect)))
+    parts.append(repr((MIGRATIONS, TABLE_MIGRATIONS)))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()[:16]
+
+async def _current_schema_version():
+    async with engine.connect() as conn:
+        exists = (await conn.execute(text("SELECT to_regclass('schema_version') IS NOT NULL"))).scalar()
+        if not exists:
+            return None
+        return (await conn.execute(text("SELECT version FROM schema_version"))).scalar()
 
 async def init_db():
-    """Создает таблицы. Если надо сбросить базу - раскомментируй drop_all"""
+    """Создает таблицы и докатывает миграции. Если база уже этой версии схемы -
+    два запроса вместо десятков запросов к каталогу. Возвращает True, если схему меняли.
+    Если надо сбросить базу - раскомментируй drop_all"""
+    version = schema_fingerprint()
+    if SCHEMA_CHECK == "version" and await _current_schema_version() == version:
+        log.info("🗄 Схема актуальна (%s)", version)
+        return False
     async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
         # await conn.run_sync(Base.metadata.drop_all) 
+        tables_before = await conn.run_sync(_existing_tables)
         await conn.run_sync(Base.metadata.create_all)
+        await upgrade_schema(conn, tables_before)
+        await conn.execute(text("DELETE FROM schema_version"))
+        await conn.execute(text("INSERT INTO schema_version (version, applied_at) VALUES (:v, now() AT TIME ZONE 'UTC')"),
+                           {"v": version})
+    log.info("🗄 Схема обновлена до %s", version)
+    return True
+
+async def get_conn():
+    """Голое соединение для Core-запросов: без ORM-сессии и гидрации объектов.
+    Незакоммиченное откатывается при возврате в пул"""
+    async with engine.connect() as conn:
+        yield conn
 
-async def get_db():
-    async with async_session() as session:
-        yield session
-        
 from sqlalchemy import update
 
-async def reset_statuses_on_startup():
-    """Сбрасывает все тревоги в 0 при запуске сервера"""
+async def recover_alerts_on_startup():
+    """Восстанавливает незавершенные тревоги после рестарта.
+
+    Трогает только строки с alert_status != 0 (частичный индекс ix_users_alert_status),
+    поэтому время старта не зависит от размера таблицы. SOS (статус 2) не сбрасывается,
+    а ожидание ответа (статус 1) продолжается до сохраненного escalate_at.
+    Возвращает число восстановленных дедлайнов."""
     async with async_session() as session:
         try:
-            # Устанавливаем alert_status = 0 для всех
-            stmt = update(User).values(alert_status=0)
-            await session.execute(stmt)
+            stmt = (
+                update(User)
+                .where(User.alert_status == 1, User.next_due_at == None, User.is_active == True)
+                .values(next_due_at=func.coalesce(
+                    User.escalate_at, User.last_checkin + seconds_interval(User.grace_seconds)
+                ))
+            )
+            result = await session.execute(stmt)
             await session.commit()
-            print("♻️ Все статусы тревоги сброшены в 0 (чистый запуск)")
+            log.info("♻️ Восстановлено дедлайнов эскалации: %s", result.rowcount)
+            return result.rowcount
         except Exception as e:
-            print(f"❌ Ошибка при сбросе статусов: {e}")
\ No newline at end of file
+            log.error("❌ Ошибка при восстановлении тревог: %s", e)
+            return 0
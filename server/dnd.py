@@ -0,0 +1,106 @@
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+from sqlalchemy import and_, or_, extract, func, text
+
+from database import User
+
+MINUTES_IN_DAY = 24 * 60
+_OFFSET_RE = re.compile(r"^(?:UTC|GMT)?\s*([+-])\s*(\d{1,2})$")
+
+
+def parse_hhmm(value):
+    """'23:30' -> 1410 (минута суток). ValueError, если время кривое"""
+    t = datetime.strptime(value.strip(), "%H:%M")
+    return t.hour * 60 + t.minute
+
+
+def normalize_timezone(value):
+    """Приводит часовой пояс к имени из базы IANA: 'Europe/Moscow' как есть,
+    смещение '+3' -> 'Etc/GMT-3' (в Etc знак перевернут). ValueError, если пояс неизвестен"""
+    value = value.strip()
+    match = _OFFSET_RE.match(value)
+    if match:
+        sign, hours = match.groups()
+        if int(hours) == 0:
+            return "UTC"
+        value = f"Etc/GMT{'-' if sign == '+' else '+'}{int(hours)}"
+    # Только имена из списка: ZoneInfo откроет и каталог ('Europe'), и служебные файлы
+    if value not in known_timezones():
+        raise ValueError(f"Неизвестный часовой пояс: {value}")
+    try:
+        get_zone(value)
+    except (ZoneInfoNotFoundError, ValueError, OSError):
+        raise ValueError(f"Неизвестный часовой пояс: {value}")
+    return value
+
+
+@lru_cache(maxsize=1)
+def known_timezones():
+    return frozenset(available_timezones())
+
+
+_pg_timezones = None
+
+
+async def pg_timezones(db):
+    """Пояса, которые знает Postgres (читаются один раз на процесс).
+    Пояс, неизвестный базе, уронил бы timezone() в UPDATE тика у всех юзеров"""
+    global _pg_timezones
+    if _pg_timezones is None:
+        _pg_timezones = frozenset((await db.execute(text("SELECT name FROM pg_timezone_names"))).scalars())
+    return _pg_timezones
+
+
+@lru_cache(maxsize=None)
+def get_zone(name):
+    return ZoneInfo(name)
+
+
+@lru_cache(maxsize=4096)
+def _local_minute(tz_name, utc_minute):
+    utc = datetime(1970, 1, 1) + timedelta(minutes=utc_minute)
+    local = utc.replace(tzinfo=get_zone("UTC")).astimezone(get_zone(tz_name))
+    return local.hour * 60 + local.minute
+
+
+def local_minute(tz_name, now):
+    """Минута суток в поясе юзера. now - naive UTC.
+    Кэш по (пояс, минута): на тике считаем один раз на каждый пояс"""
+    return _local_minute(tz_name or "UTC", int((now - datetime(1970, 1, 1)).total_seconds() // 60))
+
+
+def in_window(minute, start_min, end_min):
+    if start_min is None or end_min is None:
+        return False
+    if start_min <= end_min:
+        return start_min <= minute <= end_min
+    return minute >= start_min or minute <= end_min
+
+
+def is_in_dnd(start_min, end_min, tz_name, now):
+    if start_min is None or end_min is None:
+        return False
+    return in_window(local_minute(tz_name, now), start_min, end_min)
+
+
+def dnd_end_after(start_min, end_min, tz_name, now):
+    """Когда (naive UTC) закончится текущее окно сна"""
+    minutes_left = (end_min - local_minute(tz_name, now)) % MINUTES_IN_DAY + 1
+    return now.replace(second=0, microsecond=0) + timedelta(minutes=minutes_left)
+
+
+def in_dnd_clause(now):
+    """То же, что is_in_dnd, но в SQL: спящие отсеиваются прямо в запросе"""
+    local = func.timezone(User.timezone, func.timezone("UTC", now))
+    minute = extract("hour", local) * 60 + extract("minute", local)
+    start, end = User.dnd_start_min, User.dnd_end_min
+    return and_(
+        start.isnot(None),
+        end.isnot(None),
+        or_(
+            and_(start <= end, minute >= start, minute <= end),
+            and_(start > end, or_(minute >= start, minute <= end)),
+        ),
+    )
@@ -0,0 +1,221 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, func, literal, DateTime, Interval
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from database import engine, User, Contact, DeathNote, SosOutbox, any_of
+from telegram import dispatcher
+from metrics import Counter, Histogram
+
+# Рассылка SOS контактам. Включена по умолчанию; выключить - ESCALATION_WORKER=0
+# (тогда outbox разбирает другой процесс, например worker.py)
+ESCALATION_WORKER = os.getenv("ESCALATION_WORKER", "1") == "1"
+# Сколько сообщений берем из outbox за раз
+ESCALATION_BATCH_SIZE = int(os.getenv("ESCALATION_BATCH_SIZE", "100"))
+# Как часто проверяем outbox, если нас не разбудили (повторы и чужие тревоги)
+ESCALATION_POLL_SECONDS = float(os.getenv("ESCALATION_POLL_SECONDS", "1"))
+ESCALATION_MAX_ATTEMPTS = int(os.getenv("ESCALATION_MAX_ATTEMPTS", "10"))
+# Сколько пачек рассылается одновременно: медленный чат не держит остальные тревоги
+PARALLEL_BATCHES = 4
+# Аренда строки воркером: если он умер посреди отправки, после нее строку возьмет другой.
+# Больше, чем диспетчер может повторять одно сообщение
+LEASE = timedelta(minutes=5)
+
+# CANCELLED - юзер отметился раньше, чем сообщение ушло (см. checkin_users)
+PENDING, SENT, FAILED, CANCELLED = 0, 1, 2, 3
+
+log = logging.getLogger("escalation")
+OUTBOX_MESSAGES = Counter("sos_outbox_messages_total", "Сообщения контактам о SOS", ["result"])
+SOS_DELIVERY_SECONDS = Histogram("sos_delivery_seconds", "От тревоги до доставки сообщения контакту",
+                                 buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600))
+
+
+async def enqueue_sos(db, telegram_ids, now):
+    """Кладет в outbox по сообщению каждому контакту с Telegram (один INSERT ... SELECT).
+    Вызывается в транзакции перевода в SOS, коммит - на вызывающем"""
+    rows = (
+        select(
+            Contact.telegram_id, Contact.id, Contact.chat_id, User.display_name, DeathNote.note,
+            literal(now, DateTime), literal(now, DateTime),
+        )
+        .join(User, User.telegram_id == Contact.telegram_id)
+        .outerjoin(DeathNote, DeathNote.telegram_id == Contact.telegram_id)
+        .where(any_of(Contact.telegram_id, telegram_ids), Contact.chat_id.isnot(None))
+    )
+    stmt = (
+        pg_insert(SosOutbox)
+        .from_select(["telegram_id", "contact_id", "chat_id", "name", "note", "sos_at", "next_attempt_at"], rows)
+        .on_conflict_do_nothing(constraint="uq_sos_outbox_event")
+    )
+    return (await db.execute(stmt)).rowcount
+
+
+def render(telegram_id, name, note):
+    # Имени нет, если юзер не заходил в бот после обновления: тогда хотя бы id
+    who = name or f"Пользователь Telegram (id {telegram_id})"
+    text = f"🆘 ТРЕВОГА! {who} указал(а) вас контактом для экстренной связи и не выходит на связь."
+    if note:
+        text += f"\n\n📝 Записка:\n{note}"
+    return text
+
+
+def render_failed(contacts):
+    return (
+        "⚠️ SOS не доставлен: " + ", ".join(contacts) + ".\n"
+        "Бот может написать человеку, только если тот сам открыл бота и нажал /start. "
+        "Свяжись с ними сам."
+    )
+
+
+class EscalationWorker:
+    """Разбирает outbox: берет пачку строк с SKIP LOCKED, шлет всем контактам
+    параллельно через диспетчер и отмечает итог.
+
+    Строка отмечается доставленной один раз (UPDATE ... WHERE status = 0),
+    пока она в аренде, ее не возьмет другой воркер. Повторно сообщение
+    уйдет, только если процесс упал между ответом Telegram и отметкой.
+    """
+
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._inflight = set()
+
+    def wake(self):
+        """Новые строки в outbox - не ждем очередного опроса"""
+        self._wakeup.set()
+
+    async def _claim(self, now):
+        batch = (
+            select(SosOutbox.id)
+            .where(SosOutbox.status == PENDING, SosOutbox.next_attempt_at <= now)
+            .order_by(SosOutbox.next_attempt_at)
+            .limit(ESCALATION_BATCH_SIZE)
+            .with_for_update(skip_locked=True)
+        )
+        async with engine.connect() as db:
+            rows = (await db.execute(
+                update(SosOutbox)
+                .where(SosOutbox.id.in_(batch.scalar_subquery()))
+                .values(attempts=SosOutbox.attempts + 1, next_attempt_at=now + LEASE)
+                .returning(SosOutbox.id, SosOutbox.telegram_id, SosOutbox.chat_id, SosOutbox.name, SosOutbox.note,
+                           SosOutbox.sos_at, SosOutbox.attempts)
+                .execution_options(synchronize_session=False)
+            )).all()
+            await db.commit()
+        return rows
+
+    async def _finish(self, rows, outcomes):
+        now = datetime.utcnow()
+        sent = [row.id for row, outcome in zip(rows, outcomes) if outcome == "sent"]
+        # Отказ Telegram (бот заблокирован, чат не найден) повторять бессмысленно
+        dead = [row.id for row, outcome in zip(rows, outcomes)
+                if outcome == "rejected" or (outcome != "sent" and row.attempts >= ESCALATION_MAX_ATTEMPTS)]
+        retry = [row.id for row, outcome in zip(rows, outcomes) if outcome != "sent" and row.id not in dead]
+        async with engine.connect() as db:
+            if sent:
+                await db.execute(
+                    update(SosOutbox).where(any_of(SosOutbox.id, sent), SosOutbox.status == PENDING)
+                    .values(status=SENT, sent_at=now)
+                )
+            failed, names = [], {}
+            if dead:
+                failed = (await db.execute(
+                    update(SosOutbox).where(any_of(SosOutbox.id, dead), SosOutbox.status == PENDING)
+                    .values(status=FAILED).returning(SosOutbox.telegram_id, SosOutbox.contact_id)
+                )).all()
+                if failed:
+                    names = dict((await db.execute(
+                        select(Contact.id, Contact.info).where(any_of(Contact.id, {row.contact_id for row in failed}))
+                    )).all())
+            if retry:
+                # Экспоненциальная пауза между попытками, не больше 10 минут
+                delay = func.make_interval(
+                    0, 0, 0, 0, 0, 0, func.least(func.power(2, SosOutbox.attempts) * 5, 600), type_=Interval
+                )
+                await db.execute(
+                    update(SosOutbox).where(any_of(SosOutbox.id, retry), SosOutbox.status == PENDING)
+                    .values(next_attempt_at=literal(now, DateTime) + delay)
+                )
+            await db.commit()
+
+        for row, outcome in zip(rows, outcomes):
+            if outcome == "sent":
+                SOS_DELIVERY_SECONDS.observe((now - row.sos_at).total_seconds())
+        OUTBOX_MESSAGES.inc("sent", amount=len(sent))
+        OUTBOX_MESSAGES.inc("failed", amount=len(dead))
+        OUTBOX_MESSAGES.inc("retried", amount=len(retry))
+        if dead:
+            log.error("❌ SOS не доставлен %s контактам", len(dead))
+        await self._report_failed(failed, names)
+
+    async def _report_failed(self, failed, names):
+        """Говорит юзеру, каким контактам SOS не дошел: иначе он считает, что их предупредили"""
+        by_user = {}
+        for row in failed:
+            by_user.setdefault(row.telegram_id, []).append(names.get(row.contact_id, "удаленный контакт"))
+        for telegram_id, contacts in by_user.items():
+            await dispatcher.send(telegram_id, render_failed(contacts))
+
+    async def _deliver(self, rows):
+        outcomes = await asyncio.gather(
+            *(dispatcher.send(row.chat_id, render(row.telegram_id, row.name, row.note), wait=True) for row in rows),
+            return_exceptions=True,
+        )
+        await self._finish(rows, outcomes)
+
+    async def process(self):
+        """Одна пачка целиком. Возвращает, сколько строк обработано"""
+        rows = await self._claim(datetime.utcnow())
+        if rows:
+            await self._deliver(rows)
+        return len(rows)
+
+    def _batch_done(self, task):
+        self._inflight.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("❌ Ошибка рассылки SOS: %s", task.exception())
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if len(self._inflight) < PARALLEL_BATCHES:
+                try:
+                    rows = await self._claim(datetime.utcnow())
+                except Exception as e:
+                    log.error("❌ Ошибка чтения outbox: %s", e)
+                    rows = []
+                if rows:
+                    task = asyncio.create_task(self._deliver(rows))
+                    self._inflight.add(task)
+                    task.add_done_callback(self._batch_done)
+                    if len(rows) == ESCALATION_BATCH_SIZE:
+                        continue  # в outbox есть еще
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), ESCALATION_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if ESCALATION_WORKER and self._task is None:
+            self._task = asyncio.create_task(self._run())
+            log.info("🆘 Рассылка SOS контактам запущена.")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Недоставленное останется в outbox и уйдет после аренды (LEASE)
+        for task in list(self._inflight):
+            task.cancel()
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+
+
+escalation = EscalationWorker()
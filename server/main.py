@@ -1,37 +1,97 @@
+import time
+import asyncio
+import logging
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy import select, update, delete, insert, case, func, BigInteger, Integer, Float, String, SmallInteger, ARRAY
+from sqlalchemy import bindparam, column, literal, literal_column, text, DateTime
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
 from pydantic import BaseModel
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Импортируем наши настройки из database.py
-from database import init_db, get_db, User, reset_statuses_on_startup
-from scheduler import start_scheduler, scheduler
+from database import init_db, get_conn, engine, User, Contact, DeathNote, recover_alerts_on_startup, DEFAULT_CHECK_INTERVAL
+from database import hours_interval
+from checkins import checkin_users, checkin_buffer
+from status_cache import status_cache
+from dnd import parse_hhmm, normalize_timezone, pg_timezones
+from scheduler import start_engine, stop_engine, notify_deadline
+from escalation import enqueue_sos, escalation
+from telegram import dispatcher
+import metrics
+
+metrics.setup_logging()
+metrics.instrument_engine(engine)
+metrics.Gauge("telegram_queue_depth", "Сообщения в очереди диспетчера (включая повторы)", dispatcher.queue_depth)
+log = logging.getLogger("api")
+# Сколько /ready ждет ответа базы
+READY_DB_TIMEOUT = 2.0
 
 # Жизненный цикл (Запуск/Остановка)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print("🚀 Сервер запускается...")
-    await init_db()
-    
-    await reset_statuses_on_startup()
-    
-    await start_scheduler()
-    print("⏰ Планировщик запущен")
+    log.info("🚀 Сервер запускается...")
+    app.state.ready = False
+    timings = {}
+
+    async def timed(name, coro):
+        started = time.perf_counter()
+        result = await coro
+        timings[name] = time.perf_counter() - started
+        return result
+
+    # Схема (ждем базу) и клиент Telegram (ждем CPU) друг от друга не зависят
+    started = time.perf_counter()
+    await asyncio.gather(timed("init_db", init_db()), timed("dispatcher", dispatcher.start()))
+    await timed("recovery", recover_alerts_on_startup())
+
+    checkin_buffer.start(apply_checkins)
+    await timed("scheduler", start_engine())
+    escalation.start()
+    timings["total"] = time.perf_counter() - started
+    log.info("⏰ Планировщик запущен")
+    log.info("⏱ Фазы старта: " + ", ".join(f"{name} {sec * 1000:.0f} мс" for name, sec in timings.items()))
+    app.state.startup_timings = timings
+    app.state.ready = True
     
     yield # Здесь сервер работает
     
-    print("🛑 Выключение планировщика...")
-    scheduler.shutdown(wait=False)
-    print("🛑 Сервер остановлен")
+    app.state.ready = False
+    log.info("🛑 Выключение планировщика...")
+    await checkin_buffer.stop()
+    await stop_engine()
+    await escalation.stop()
+    await dispatcher.stop()
+    await status_cache.close()
+    log.info("🛑 Сервер остановлен")
 
 app = FastAPI(lifespan=lifespan)
 
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    # scope общий с роутером: после маршрутизации в нем появится endpoint
+    token = metrics.request_scope.set(request.scope)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.request_scope.reset(token)
+    metrics.HTTP_SECONDS.observe(
+        time.perf_counter() - started, metrics.current_endpoint_of(request.scope), response.status_code
+    )
+    return response
+
 # Модели данных 
 class UserRegister(BaseModel):
     telegram_id: int
 
+class UserSignup(UserRegister):
+    # Как юзера увидят контакты в SOS: имя из Telegram и @username
+    display_name: str | None = None
+
 class UserSettings(BaseModel):
     telegram_id: int
     check_interval: float | None = None
@@ -39,6 +99,24 @@ class UserSettings(BaseModel):
     contacts: list | None = None
     dnd_start: str | None = None
     dnd_end: str | None = None
+    timezone: str | None = None
+    grace_seconds: int | None = None
+    reminders: int | None = None
+
+class CheckinBatch(BaseModel):
+    telegram_ids: list[int]
+
+class SettingsBatch(BaseModel):
+    items: list[UserSettings]
+
+class ContactAdd(BaseModel):
+    telegram_id: int
+    info: str
+    chat_id: int | None = None  # Telegram контакта, если известен - ему уйдет SOS
+
+class ContactRemove(BaseModel):
+    telegram_id: int
+    contact_id: int
 
 # API Ручки (Endpoints)
 
@@ -46,93 +124,360 @@ class UserSettings(BaseModel):
 async def root():
     return {"status": "ok", "message": "Server is running"}
 
-@app.post("/register")
-async def register_user(user_data: UserRegister, db: AsyncSession = Depends(get_db)):
-    query = select(User).where(User.telegram_id == user_data.telegram_id)
-    result = await db.execute(query)
-    existing_user = result.scalar_one_or_none()
+@app.get("/ready")
+async def ready(request: Request):
+    """Готовность принимать трафик (для балансировщика и healthcheck): старт
+    закончен и база отвечает. "/" - только признак того, что процесс жив"""
+    if not getattr(request.app.state, "ready", False):
+        return JSONResponse({"status": "starting"}, status_code=503)
+    try:
+        async with engine.connect() as conn:
+            await asyncio.wait_for(conn.execute(text("SELECT 1")), READY_DB_TIMEOUT)
+    except Exception as e:
+        return JSONResponse({"status": "db_unavailable", "detail": str(e)}, status_code=503)
+    return {"status": "ready", "startup_ms": {k: round(v * 1000) for k, v in request.app.state.startup_timings.items()}}
 
-    if existing_user:
-        return {"status": "exists", "user_id": existing_user.telegram_id}
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    new_user = User(telegram_id=user_data.telegram_id)
-    db.add(new_user)
-    
+@app.post("/register")
+async def register_user(user_data: UserSignup, db: AsyncConnection = Depends(get_conn)):
+    # Один INSERT ... ON CONFLICT: у существующего юзера обновляем только имя,
+    # и только если оно поменялось (повторный /start обычно ничего не пишет)
+    now = datetime.utcnow()
+    stmt = pg_insert(User).values(
+        telegram_id=user_data.telegram_id,
+        display_name=user_data.display_name,
+        last_checkin=now,
+        next_due_at=now + timedelta(hours=DEFAULT_CHECK_INTERVAL),
+    )
+    stmt = (
+        stmt.on_conflict_do_update(
+            index_elements=[User.telegram_id],
+            set_={"display_name": stmt.excluded.display_name},
+            where=stmt.excluded.display_name.isnot(None)
+            & User.display_name.is_distinct_from(stmt.excluded.display_name),
+        )
+        # xmax = 0 - строка вставлена, а не обновлена
+        .returning(User.next_due_at, literal_column("users.xmax = 0").label("created"))
+    )
     try:
+        row = (await db.execute(stmt)).one_or_none()
         await db.commit()
-        return {"status": "created", "user_id": user_data.telegram_id}
     except Exception as e:
         await db.rollback()
-        print(f"Ошибка БД: {e}")
+        log.error("Ошибка БД: %s", e)
         raise HTTPException(status_code=500, detail="Ошибка при сохранении")
 
+    if row is None or not row.created:
+        return {"status": "exists", "user_id": user_data.telegram_id}
+    notify_deadline(user_data.telegram_id, row.next_due_at)
+    return {"status": "created", "user_id": user_data.telegram_id}
+
+def apply_checkins(rows):
+    for row in rows:
+        if row.prev_status == 2:
+            log.info("🔔 [ОТБОЙ] Юзер %s сбросил статус SOS в ручном режиме.", row.telegram_id)
+        notify_deadline(row.telegram_id, row.next_due_at)
+
 @app.post("/checkin")
-async def checkin_user(user_data: UserRegister, db: AsyncSession = Depends(get_db)):
-    query = select(User).where(User.telegram_id == user_data.telegram_id)
-    result = await db.execute(query)
-    user = result.scalar_one_or_none()
-
-    if user:
-        if user.alert_status == 2:
-            print(f"🔔 [ОТБОЙ] Юзер {user.telegram_id} сбросил статус SOS в ручном режиме.")
-
-        # ПРИНУДИТЕЛЬНО обновляем всё:
-        user.last_checkin = datetime.utcnow()
-        user.alert_status = 0                 
-        
+async def checkin_user(user_data: UserRegister):
+    if checkin_buffer.enabled:
+        # Запишется пачкой в течение CHECKIN_BUFFER_MS, юзер в базе не проверяется
+        checkin_buffer.add(user_data.telegram_id, datetime.utcnow())
+        await status_cache.invalidate(user_data.telegram_id)
+        return {"status": "ok", "buffered": True}
+    # Соединение из пула берем только здесь: буферизованный чекин базу не трогает
+    async with engine.connect() as db:
+        # ПРИНУДИТЕЛЬНО обновляем всё одним UPDATE ... RETURNING
+        rows = await checkin_users(db, [user_data.telegram_id], datetime.utcnow())
         await db.commit()
-        print(f"✅ Мониторинг для {user.telegram_id} возобновлен. Статус: 0, Таймер: 0с.")
-        return {"status": "ok"}
-    
-    raise HTTPException(status_code=404, detail="User not found")
+    await status_cache.invalidate(user_data.telegram_id)
+    if not rows:
+        raise HTTPException(status_code=404, detail="User not found")
+    apply_checkins(rows)
+    log.debug("✅ Мониторинг для %s возобновлен", user_data.telegram_id)
+    return {"status": "ok"}
 
-@app.post("/update_settings")
-async def update_settings(data: UserSettings, db: AsyncSession = Depends(get_db)):
-    print(f"⚙️ Обновление настроек для {data.telegram_id}")
-    
+@app.post("/checkin/batch")
+async def checkin_batch(data: CheckinBatch, db: AsyncConnection = Depends(get_conn)):
+    """Сотни чекинов за один запрос к базе (для бота/шлюза, который копит нажатия)"""
+    rows = await checkin_users(db, set(data.telegram_ids), datetime.utcnow())
+    await db.commit()
+    await status_cache.invalidate(*(row.telegram_id for row in rows))
+    apply_checkins(rows)
+    found = {row.telegram_id for row in rows}
+    return {"status": "ok", "updated": len(found), "missing": sorted(set(data.telegram_ids) - found)}
+
+# Границы окна ответа на предупреждение и числа напоминаний
+MIN_GRACE_SECONDS, MAX_GRACE_SECONDS = 30, 24 * 3600
+MAX_REMINDERS = 10
+
+def parse_settings(data: UserSettings):
+    """Поля настроек для UPDATE users (без контактов и записки). 400, если время или пояс кривые"""
     update_data = {}
     if data.check_interval is not None: update_data["check_interval"] = data.check_interval
-    if data.death_note is not None: update_data["death_note"] = data.death_note
-    if data.contacts is not None: update_data["contacts"] = data.contacts
-    if data.dnd_start is not None: update_data["dnd_start"] = data.dnd_start
-    if data.dnd_end is not None: update_data["dnd_end"] = data.dnd_end
+    try:
+        # Границы сна разбираем один раз здесь, планировщик работает с минутами суток
+        if data.dnd_start is not None:
+            update_data["dnd_start"] = data.dnd_start.strip()
+            update_data["dnd_start_min"] = parse_hhmm(data.dnd_start)
+        if data.dnd_end is not None:
+            update_data["dnd_end"] = data.dnd_end.strip()
+            update_data["dnd_end_min"] = parse_hhmm(data.dnd_end)
+        if data.timezone is not None:
+            update_data["timezone"] = normalize_timezone(data.timezone)
+        # Новое окно начнет действовать со следующего предупреждения
+        if data.grace_seconds is not None:
+            if not MIN_GRACE_SECONDS <= data.grace_seconds <= MAX_GRACE_SECONDS:
+                raise ValueError(f"grace_seconds должен быть от {MIN_GRACE_SECONDS} до {MAX_GRACE_SECONDS}")
+            update_data["grace_seconds"] = data.grace_seconds
+        if data.reminders is not None:
+            if not 0 <= data.reminders <= MAX_REMINDERS:
+                raise ValueError(f"reminders должен быть от 0 до {MAX_REMINDERS}")
+            update_data["reminders"] = data.reminders
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"{data.telegram_id}: {e}")
+    return update_data
+
+async def check_timezones(db: AsyncConnection, parsed: dict):
+    """400, если Postgres не знает пояс, хотя Python его знает. parsed - {telegram_id: поля}"""
+    for telegram_id, values in parsed.items():
+        tz = values.get("timezone")
+        if tz is not None and tz not in await pg_timezones(db):
+            raise HTTPException(status_code=400, detail=f"{telegram_id}: Неизвестный часовой пояс: {tz}")
+
+async def save_notes(db: AsyncConnection, notes: dict):
+    """Записки пачкой: INSERT ... SELECT FROM unnest(...) ON CONFLICT DO UPDATE.
+    Пишутся только для существующих юзеров. Возвращает их telegram_id"""
+    v = (
+        func.unnest(
+            bindparam("note_tid", list(notes), type_=ARRAY(BigInteger)),
+            bindparam("note", list(notes.values()), type_=ARRAY(String)),
+        )
+        .table_valued(column("tid", BigInteger), column("note", String))
+        .render_derived(name="n")
+    )
+    rows = (
+        select(v.c.tid, v.c.note, literal(datetime.utcnow(), DateTime))
+        .select_from(v).join(User, User.telegram_id == v.c.tid)
+    )
+    stmt = pg_insert(DeathNote).from_select(["telegram_id", "note", "updated_at"], rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DeathNote.telegram_id],
+        set_={"note": stmt.excluded.note, "updated_at": stmt.excluded.updated_at},
+    ).returning(DeathNote.telegram_id)
+    return set((await db.execute(stmt)).scalars())
+
+@app.post("/update_settings")
+async def update_settings(data: UserSettings, db: AsyncConnection = Depends(get_conn)):
+    log.debug("⚙️ Обновление настроек для %s", data.telegram_id)
+    
+    update_data = parse_settings(data)
+    await check_timezones(db, {data.telegram_id: update_data})
+
+    if data.death_note is not None:
+        await save_notes(db, {data.telegram_id: data.death_note})
     
+    if data.contacts is not None:
+        # Полная замена списка (для поштучного изменения есть /contacts/add и /contacts/remove)
+        await db.execute(delete(Contact).where(Contact.telegram_id == data.telegram_id))
+        rows = [
+            {"telegram_id": data.telegram_id, "info": c["info"], "chat_id": c.get("chat_id")}
+            for c in data.contacts if isinstance(c, dict) and c.get("info")
+        ]
+        if rows:
+            try:
+                await db.execute(insert(Contact), rows)
+            except IntegrityError:
+                # Внешний ключ на users: юзера нет (как в /contacts/add)
+                await db.rollback()
+                raise HTTPException(status_code=404, detail="User not found")
+
     if not update_data:
-        return {"status": "nothing_to_update"}
+        if data.death_note is None and data.contacts is None:
+            return {"status": "nothing_to_update"}
+        # Строку users не трогаем: записка и контакты живут в своих таблицах
+        await db.commit()
+        await status_cache.invalidate(data.telegram_id)
+        return {"status": "ok"}
 
-    stmt = update(User).where(User.telegram_id == data.telegram_id).values(**update_data)
-    await db.execute(stmt)
+    if data.check_interval is not None:
+        # Новый интервал сдвигает дедлайн, но только если тревоги сейчас нет
+        update_data["next_due_at"] = case(
+            (User.alert_status == 0, User.last_checkin + timedelta(hours=data.check_interval)),
+            else_=User.next_due_at,
+        )
+
+    stmt = (
+        update(User).where(User.telegram_id == data.telegram_id).values(**update_data)
+        .returning(User.next_due_at, User.dnd_start_min, User.dnd_end_min, User.timezone)
+    )
+    row = (await db.execute(stmt)).one_or_none()
     await db.commit()
+    await status_cache.invalidate(data.telegram_id)
+    if row:
+        notify_deadline(data.telegram_id, row.next_due_at, (row.dnd_start_min, row.dnd_end_min, row.timezone))
     return {"status": "ok"}
 
+# Колонки, которые можно менять пачкой, и их типы для unnest
+BATCH_SETTINGS_COLUMNS = [
+    ("check_interval", Float),
+    ("dnd_start", String), ("dnd_start_min", SmallInteger),
+    ("dnd_end", String), ("dnd_end_min", SmallInteger),
+    ("timezone", String),
+    ("grace_seconds", Integer), ("reminders", SmallInteger),
+]
+
+@app.post("/update_settings/batch")
+async def update_settings_batch(data: SettingsBatch, db: AsyncConnection = Depends(get_conn)):
+    """Настройки для многих юзеров одним UPDATE ... FROM unnest(...).
+    Не переданное поле (None) оставляет старое значение. Контакты - через /contacts/*"""
+    if any(item.contacts is not None for item in data.items):
+        raise HTTPException(status_code=400, detail="Контакты пачкой не меняются, используйте /contacts/*")
+
+    # Один юзер - одна строка (последняя побеждает)
+    parsed = {item.telegram_id: parse_settings(item) for item in data.items}
+    notes = {item.telegram_id: item.death_note for item in data.items if item.death_note is not None}
+    # Юзеры, у которых меняется только записка, в UPDATE users не попадают
+    parsed = {tid: values for tid, values in parsed.items() if values}
+    await check_timezones(db, parsed)
+    if not parsed and not notes:
+        return {"status": "nothing_to_update"}
+
+    noted = await save_notes(db, notes) if notes else set()
+    if not parsed:
+        await db.commit()
+        await status_cache.invalidate(*noted)
+        return {"status": "ok", "updated": len(noted)}
+
+    arrays = [bindparam("tid", list(parsed), type_=ARRAY(BigInteger))]
+    for name, type_ in BATCH_SETTINGS_COLUMNS:
+        arrays.append(bindparam(name, [values.get(name) for values in parsed.values()], type_=ARRAY(type_)))
+    v = (
+        func.unnest(*arrays)
+        .table_valued(column("tid", BigInteger), *(column(name, t) for name, t in BATCH_SETTINGS_COLUMNS))
+        .render_derived(name="v")
+    )
+
+    values = {name: func.coalesce(v.c[name], getattr(User, name)) for name, _ in BATCH_SETTINGS_COLUMNS}
+    # Новый интервал сдвигает дедлайн, но только если тревоги сейчас нет
+    values["next_due_at"] = case(
+        (v.c.check_interval.isnot(None) & (User.alert_status == 0),
+         User.last_checkin + hours_interval(v.c.check_interval)),
+        else_=User.next_due_at,
+    )
+    stmt = (
+        update(User).where(User.telegram_id == v.c.tid).values(**values)
+        .returning(User.telegram_id, User.next_due_at, User.dnd_start_min, User.dnd_end_min, User.timezone)
+        .execution_options(synchronize_session=False)
+    )
+    rows = (await db.execute(stmt)).all()
+    await db.commit()
+    updated = noted | {row.telegram_id for row in rows}
+    await status_cache.invalidate(*updated)
+    for row in rows:
+        notify_deadline(row.telegram_id, row.next_due_at, (row.dnd_start_min, row.dnd_end_min, row.timezone))
+    return {"status": "ok", "updated": len(updated)}
+
 @app.get("/status/{telegram_id}")
-async def get_status(telegram_id: int, db: AsyncSession = Depends(get_db)):
-    query = select(User).where(User.telegram_id == telegram_id)
-    result = await db.execute(query)
-    user = result.scalar_one_or_none()
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    return {
+async def get_status(telegram_id: int):
+    # Самый частый запрос бота: сначала кэш, база - только на промахе.
+    # Поэтому соединение из пула берем после кэша, попадание его не занимает
+    cached, version = await status_cache.get(telegram_id)
+    if cached is not None:
+        return cached
+
+    # Только нужные колонки, без сборки объекта User
+    query = (
+        select(User.check_interval, User.dnd_start, User.dnd_end, User.grace_seconds, User.reminders,
+               DeathNote.note)
+        .outerjoin(DeathNote, DeathNote.telegram_id == User.telegram_id)
+        .where(User.telegram_id == telegram_id)
+    )
+    async with engine.connect() as db:
+        user = (await db.execute(query)).one_or_none()
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        contacts = await list_user_contacts(db, telegram_id)
+
+    profile = {
         "check_interval": user.check_interval,
-        "death_note": user.death_note or "Не установлена",
+        "death_note": user.note or "Не установлена",
         "dnd": f"{user.dnd_start}-{user.dnd_end}" if user.dnd_start else "Не установлен",
-        "contacts": user.contacts or []
+        "grace_seconds": user.grace_seconds,
+        "reminders": user.reminders,
+        "contacts": contacts
     }
+    await status_cache.put(telegram_id, profile, version)
+    return profile
+
+async def list_user_contacts(db: AsyncConnection, telegram_id: int):
+    result = await db.execute(
+        select(Contact.id, Contact.info, Contact.chat_id).where(Contact.telegram_id == telegram_id).order_by(Contact.id)
+    )
+    return [{"id": row.id, "info": row.info, "chat_id": row.chat_id} for row in result]
+
+@app.get("/contacts/{telegram_id}")
+async def get_contacts(telegram_id: int, db: AsyncConnection = Depends(get_conn)):
+    return {"contacts": await list_user_contacts(db, telegram_id)}
+
+@app.post("/contacts/add")
+async def add_contact(data: ContactAdd, db: AsyncConnection = Depends(get_conn)):
+    # Один INSERT, не зависит от длины списка
+    stmt = (
+        insert(Contact).values(telegram_id=data.telegram_id, info=data.info, chat_id=data.chat_id)
+        .returning(Contact.id)
+    )
+    try:
+        contact_id = (await db.execute(stmt)).scalar_one()
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=404, detail="User not found")
+    await status_cache.invalidate(data.telegram_id)
+    log.debug("👥 Контакт добавлен для %s", data.telegram_id)
+    return {"status": "ok", "id": contact_id}
+
+@app.post("/contacts/remove")
+async def remove_contact(data: ContactRemove, db: AsyncConnection = Depends(get_conn)):
+    stmt = delete(Contact).where(Contact.id == data.contact_id, Contact.telegram_id == data.telegram_id)
+    result = await db.execute(stmt)
+    await db.commit()
+    await status_cache.invalidate(data.telegram_id)
+    if not result.rowcount:
+        raise HTTPException(status_code=404, detail="Contact not found")
+    return {"status": "removed"}
 
 @app.post("/clear_contacts")
-async def clear_contacts(user_data: UserRegister, db: AsyncSession = Depends(get_db)):
-    stmt = update(User).where(User.telegram_id == user_data.telegram_id).values(contacts=[])
+async def clear_contacts(user_data: UserRegister, db: AsyncConnection = Depends(get_conn)):
+    stmt = delete(Contact).where(Contact.telegram_id == user_data.telegram_id)
     await db.execute(stmt)
     await db.commit()
-    print(f"🗑 Контакты очищены для {user_data.telegram_id}")
+    await status_cache.invalidate(user_data.telegram_id)
+    log.debug("🗑 Контакты очищены для %s", user_data.telegram_id)
     return {"status": "cleared"}
 
 @app.post("/sos_manual")
-async def manual_sos_trigger(user_data: UserRegister, db: AsyncSession = Depends(get_db)):
-    stmt = update(User).where(User.telegram_id == user_data.telegram_id).values(alert_status=2)
-    await db.execute(stmt)
-    await db.commit()
-    print(f"🚨 РУЧНОЙ SOS для {user_data.telegram_id}")
+async def manual_sos_trigger(user_data: UserRegister):
+    # Отложенный чекин не должен сбросить тревогу, поднятую после него: убираем его
+    # из буфера, а если он уже пишется - ждем коммита (соединение пока не держим)
+    await checkin_buffer.discard(user_data.telegram_id)
+    # Повторное нажатие во время тревоги не рассылает контактам еще раз
+    stmt = (
+        update(User).where(User.telegram_id == user_data.telegram_id, User.alert_status != 2)
+        .values(alert_status=2, next_due_at=None).returning(User.telegram_id)
+    )
+    async with engine.connect() as db:
+        raised = (await db.execute(stmt)).scalar_one_or_none()
+        if raised is not None:
+            await enqueue_sos(db, [raised], datetime.utcnow())
+        await db.commit()
+    await status_cache.invalidate(user_data.telegram_id)
+    notify_deadline(user_data.telegram_id, None)
+    if raised is not None:
+        escalation.wake()
+    log.info("🚨 РУЧНОЙ SOS для %s", user_data.telegram_id)
     return {"status": "sos_activated"}
 
@@ -0,0 +1,177 @@
+import os
+import time
+import random
+import logging
+from bisect import bisect_left
+from contextvars import ContextVar
+
+# Минимальные метрики в формате Prometheus (без внешних зависимостей).
+# Все значения живут в памяти процесса, /metrics отдает их текстом.
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _label_str(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for values, v in self._values.items():
+            yield f"{self.name}{_label_str(self.labels, values)} {v}"
+
+
+class Gauge:
+    """Значение считается в момент запроса /metrics функцией fn"""
+
+    def __init__(self, name, doc, fn):
+        self.name, self.doc, self.fn = name, doc, fn
+        _registry.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} gauge"
+        try:
+            value = self.fn()
+        except Exception:
+            return
+        yield f"{self.name} {value}"
+
+
+class Histogram:
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.doc, self.labels = name, doc, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [счетчики по бакетам, сумма, количество]
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        data = self._values.get(label_values)
+        if data is None:
+            data = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            data[0][i] += 1
+        data[1] += value
+        data[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        for values, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                yield f"{self.name}_bucket{_label_str(self.labels + ('le',), values + (bound,))} {cumulative}"
+            yield f"{self.name}_bucket{_label_str(self.labels + ('le',), values + ('+Inf',))} {count}"
+            yield f"{self.name}_sum{_label_str(self.labels, values)} {total}"
+            yield f"{self.name}_count{_label_str(self.labels, values)} {count}"
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Метрики, общие для модулей сервера
+TICK_DURATION = Histogram("scheduler_tick_seconds", "Длительность тика планировщика")
+TICK_TOTAL = Counter("scheduler_ticks_total", "Сколько тиков выполнено")
+USERS_PROCESSED = Counter("scheduler_users_processed_total",
+                          "Юзеры с наступившим дедлайном, которых тик перевел в новый статус")
+TRANSITIONS = Counter("scheduler_transitions_total", "Переходы статуса тревоги", ["transition"])
+HTTP_SECONDS = Histogram("http_request_seconds", "Время обработки HTTP-запроса", ["endpoint", "status"])
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Время SQL-запроса", ["endpoint"])
+TELEGRAM_SEND_SECONDS = Histogram("telegram_send_seconds", "Время запроса sendMessage к Telegram")
+TELEGRAM_MESSAGES = Counter("telegram_messages_total", "Исходящие сообщения по результату", ["result"])
+
+
+# SQL: время каждого запроса с разбивкой по эндпоинту, который его сделал.
+# Эндпоинт берем из ASGI scope текущего HTTP-запроса (его кладет middleware в main.py)
+request_scope = ContextVar("request_scope", default=None)
+
+
+def current_endpoint_of(scope):
+    endpoint = scope.get("endpoint") if scope else None
+    return endpoint.__name__ if endpoint else "background"
+
+
+def current_endpoint():
+    return current_endpoint_of(request_scope.get())
+
+
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    # Время старта - в контексте выполнения: он живет один запрос, так что упавший
+    # запрос (after_cursor_execute для него не вызывается) ничего после себя не оставит
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context._query_started = time.perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERY_SECONDS.observe(time.perf_counter() - context._query_started, current_endpoint())
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before)
+    event.listen(engine.sync_engine, "after_cursor_execute", after)
+
+    pool = engine.pool
+    Gauge("db_pool_size", "Размер пула соединений", pool.size)
+    Gauge("db_pool_checked_out", "Соединения, занятые прямо сейчас", pool.checkedout)
+    Gauge("db_pool_overflow", "Соединения сверх pool_size", pool.overflow)
+    Gauge("db_pool_checked_in", "Свободные соединения в пуле", pool.checkedin)
+
+
+# ЛОГИ
+# Уровень задается LOG_LEVEL, подробные строки про каждого юзера пишутся на DEBUG
+# и прореживаются LOG_SAMPLE_RATE (доля от 0 до 1). Пока DEBUG выключен,
+# они не стоят ничего: проверка isEnabledFor идет до форматирования.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+
+class KeyValueFormatter(logging.Formatter):
+    """'время уровень логгер сообщение key=value ...' - удобно грепать и парсить"""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+def setup_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(KeyValueFormatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+
+
+def log_event(log, level, message, **fields):
+    if log.isEnabledFor(level):
+        log.log(level, message, extra={"fields": fields})
+
+
+def sampled():
+    return LOG_SAMPLE_RATE >= 1.0 or random.random() < LOG_SAMPLE_RATE
@@ -1,78 +1,542 @@
 import os
-import httpx
+import time
+import asyncio
+import logging
+import heapq
+import random
 from datetime import datetime, timedelta, timezone
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from sqlalchemy import select
+from sqlalchemy import select, update, not_, text, func, case, literal, true, DateTime
 from dotenv import load_dotenv
-from    database import async_session, User
+from    database import engine, User, any_of, seconds_interval
+from telegram import dispatcher
+from checkins import checkin_buffer
+from escalation import enqueue_sos, escalation
+from dnd import is_in_dnd, dnd_end_after, in_dnd_clause
+from metrics import Gauge, TICK_DURATION, TICK_TOTAL, USERS_PROCESSED, TRANSITIONS, log_event, sampled
 
 load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-scheduler = AsyncIOScheduler()
+# Движок планировщика:
+# "poll" - опрос базы раз в 10 секунд, "timer" - куча дедлайнов в памяти,
+# "partitioned" - опрос только своих шардов (можно запускать много реплик),
+# "off" - API без планировщика (тики крутит отдельный worker.py)
+SCHEDULER_ENGINE = os.getenv("SCHEDULER_ENGINE", "poll")
+# Как часто тикает опрос (poll и partitioned)
+TICK_SECONDS = float(os.getenv("SCHEDULER_TICK_SECONDS", "10"))
+# На сколько шардов делим юзеров (telegram_id % SHARD_COUNT). Менять только
+# при остановленных воркерах
+SHARD_COUNT = int(os.getenv("SCHEDULER_SHARDS", "64"))
+# APScheduler нужен только движку poll: создается в start_scheduler
+scheduler = None
+log = logging.getLogger("scheduler")
+
+OK_KEYBOARD = {"inline_keyboard": [[{"text": "🟢 Я В ПОРЯДКЕ", "callback_data": "i_am_ok"}]]}
 
 async def send_telegram_alert(chat_id: int, text: str):
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": chat_id, 
-        "text": text,
-        "reply_markup": {"inline_keyboard": [[{"text": "🟢 Я В ПОРЯДКЕ", "callback_data": "i_am_ok"}]]}
-    }
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            await client.post(url, json=payload)
-        except Exception as e:
-            print(f"❌ Ошибка отправки: {e}")
-
-def is_now_in_dnd(start_str, end_str):
-    if not start_str or not end_str:
-        return False
-    now_time = datetime.now().strftime("%H:%M")
-    if start_str <= end_str:
-        return start_str <= now_time <= end_str
-    else:
-        return now_time >= start_str or now_time <= end_str
+    # Не ждем Telegram: сообщение уходит в очередь диспетчера (telegram.py)
+    await dispatcher.send(chat_id, text, reply_markup=OK_KEYBOARD)
+
+# Сколько просроченных юзеров переводим одним запросом
+BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "1000"))
+
+def _due_scope(now, status, stage, telegram_ids, shards):
+    # Чекины, которые еще лежат в буфере, для планировщика уже сделаны
+    buffered = checkin_buffer.pending_ids()
+    if telegram_ids is not None:
+        return any_of(User.telegram_id, [tid for tid in telegram_ids if tid not in buffered])
+    # Пачка просроченных и не спящих юзеров (по индексу ix_users_next_due_at).
+    # Режим сна проверяется в самом запросе, спящие даже не читаются
+    conditions = [
+        User.next_due_at <= now,
+        User.alert_status == status,
+        stage,
+        User.is_active == True,
+        not_(in_dnd_clause(now)),
+    ]
+    if shards is not None:
+        conditions.append(any_of(User.telegram_id % SHARD_COUNT, shards))
+    if buffered:
+        conditions.append(not_(any_of(User.telegram_id, list(buffered))))
+    batch = (
+        select(User.id)
+        .where(*conditions)
+        .limit(BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    )
+    return User.id.in_(batch.scalar_subquery())
+
+async def _transition(db, now, status, stage, values, returning, telegram_ids, shards):
+    rows = []
+    while True:
+        result = await db.execute(
+            update(User)
+            .where(
+                _due_scope(now, status, stage, telegram_ids, shards),
+                User.alert_status == status, stage, User.next_due_at <= now,
+            )
+            .values(**values)
+            .returning(*returning)
+            .execution_options(synchronize_session=False)
+        )
+        batch = result.all()
+        rows.extend(batch)
+        if telegram_ids is not None or len(batch) < BATCH_SIZE:
+            return rows
+
+def _stage_at(stage):
+    """Время напоминания номер stage (1..reminders) от предупреждения.
+    Напоминания делят на равные части окно, зафиксированное при предупреждении
+    (escalate_at - warned_at): новый grace_seconds начнет действовать со следующего"""
+    window = func.extract("epoch", User.escalate_at - User.warned_at)
+    return User.warned_at + seconds_interval(window * stage / (User.reminders + 1))
 
-async def check_users_job():
+async def apply_transitions(db, now, telegram_ids=None, shards=None):
+    """Переводит просроченных юзеров одним UPDATE ... RETURNING на каждый переход
+    (и на каждую пачку из BATCH_SIZE): 1 -> 2 (SOS), 1 -> 1 (очередное напоминание)
+    и 0 -> 1 (предупреждение). Этапы эскалации хранятся в warned_at/escalate_at,
+    next_due_at всегда указывает на ближайший из них.
+    telegram_ids=None - все просроченные и не спящие, иначе только эти юзеры.
+    shards - ограничить шардами (telegram_id % SHARD_COUNT) этого воркера.
+    Условие по статусу и дедлайну защищает от гонок с /checkin.
+    Сообщения контактам о SOS пишутся в outbox в той же транзакции.
+    Возвращает (предупрежденные, напомненные, SOS)"""
+    # Дошли до escalate_at (или старая строка без этапов) - SOS
+    sos_stage = (User.escalate_at == None) | (User.next_due_at >= User.escalate_at)
+    sos_rows = await _transition(
+        db, now, 1, sos_stage, {"alert_status": 2, "next_due_at": None}, [User.telegram_id], telegram_ids, shards
+    )
+    if sos_rows:
+        await enqueue_sos(db, [row.telegram_id for row in sos_rows], now)
+
+    reminded_rows = await _transition(
+        db, now, 1, User.next_due_at < User.escalate_at,
+        {
+            "reminders_sent": User.reminders_sent + 1,
+            # В SET видны старые значения: reminders_sent + 2 - номер следующего напоминания
+            "next_due_at": case(
+                (User.reminders_sent + 1 < User.reminders, _stage_at(User.reminders_sent + 2)),
+                else_=User.escalate_at,
+            ),
+        },
+        [User.telegram_id, User.next_due_at, User.escalate_at],
+        telegram_ids,
+        shards,
+    )
+
+    # last_checkin не трогаем: это время настоящей отметки юзера
+    warned_at = literal(now, DateTime)
+    warned_rows = await _transition(
+        db, now, 0, true(),
+        {
+            "alert_status": 1,
+            "warned_at": warned_at,
+            "escalate_at": warned_at + seconds_interval(User.grace_seconds),
+            "reminders_sent": 0,
+            "next_due_at": warned_at + seconds_interval(User.grace_seconds / (User.reminders + 1)),
+        },
+        [User.telegram_id, User.next_due_at],
+        telegram_ids,
+        shards,
+    )
+    await db.commit()
+    return warned_rows, reminded_rows, [row.telegram_id for row in sos_rows]
+
+def _left(escalate_at, now):
+    seconds = max(0, round((escalate_at - now).total_seconds()))
+    return f"{seconds // 60} мин" if seconds >= 120 else f"{seconds} с"
+
+async def notify_transitions(warned_rows, reminded_rows, sos_ids):
+    TRANSITIONS.inc("warning", amount=len(warned_rows))
+    TRANSITIONS.inc("reminder", amount=len(reminded_rows))
+    TRANSITIONS.inc("sos", amount=len(sos_ids))
+    if sos_ids:
+        escalation.wake()
+    # Строка на юзера - только на DEBUG и с прореживанием
+    debug = log.isEnabledFor(logging.DEBUG)
+    for tid, _ in warned_rows:
+        if debug and sampled():
+            log_event(log, logging.DEBUG, "⚠️ предупреждение", telegram_id=tid)
+        await send_telegram_alert(tid, "⏳ Время вышло! Ты в порядке?")
     now = datetime.utcnow()
-    print(f"⏰ --- СЕССИЯ ПРОВЕРКИ {now.strftime('%H:%M:%S')} ---")
-    
-    async with async_session() as db:
-        result = await db.execute(select(User).where(User.is_active == True))
-        users = result.scalars().all()
-
-        if not users:
-            print("ℹ️ В базе нет активных пользователей.")
-
-        for user in users:
-            # 1. Проверка сна
-            if is_now_in_dnd(user.dnd_start, user.dnd_end):
-                print(f"💤 Юзер {user.telegram_id} спит ({user.dnd_start}-{user.dnd_end}). Пропускаю.")
-                continue
+    for tid, _, escalate_at in reminded_rows:
+        if debug and sampled():
+            log_event(log, logging.DEBUG, "🔔 напоминание", telegram_id=tid)
+        await send_telegram_alert(tid, f"🔔 Напоминание: ты не ответил. SOS через {_left(escalate_at, now)}!")
+    for tid in sos_ids:
+        if debug and sampled():
+            log_event(log, logging.DEBUG, "🚨 SOS", telegram_id=tid)
+        await send_telegram_alert(tid, "🆘 ТРЕВОГА! Пишу контактам из Telegram (📨), о недоставленных сообщу. Остальным сообщи сам.")
+
+async def check_users_job(shards=None):
+    started = time.perf_counter()
+    now = datetime.utcnow()
+
+    async with engine.connect() as db:
+        warned_rows, reminded_rows, sos_ids = await apply_transitions(db, now, shards=shards)
 
-            # 2. Расчет времени
-            time_passed = now - user.last_checkin
-            seconds_passed = time_passed.total_seconds()
-            threshold = user.check_interval * 3600
+    # Уведомления - после того как статусы сохранены
+    await notify_transitions(warned_rows, reminded_rows, sos_ids)
 
-            print(f"👤 Юзер {user.telegram_id}: прошло {seconds_passed:.0f}с / порог {threshold:.0f}с | статус: {user.alert_status}")
+    duration = time.perf_counter() - started
+    processed = len(warned_rows) + len(reminded_rows) + len(sos_ids)
+    TICK_TOTAL.inc()
+    TICK_DURATION.observe(duration)
+    USERS_PROCESSED.inc(amount=processed)
+    log_event(log, logging.INFO if processed else logging.DEBUG, "⏰ тик",
+              warned=len(warned_rows), reminded=len(reminded_rows), sos=len(sos_ids), ms=round(duration * 1000, 1))
+    return processed
 
-            # 3. Логика
-            if seconds_passed > threshold and user.alert_status == 0:
-                print(f"⚠️ ТРИГГЕР: Шлю предупреждение юзеру {user.telegram_id}")
-                await send_telegram_alert(user.telegram_id, f"⏳ Время вышло! Ты в порядке?")
-                user.alert_status = 1
-                user.last_checkin = datetime.utcnow()
-                await db.commit()
+# Тик раз в TICK_SECONDS сам по себе опоздал бы на этап эскалации до TICK_SECONDS.
+# Если ближайший дедлайн раньше следующего тика - ставим разовый запуск ровно к нему
+PRECISE_JOB_ID = "precise_tick"
 
-            elif seconds_passed > 60 and user.alert_status == 1: # Даем 60 сек на ответ
-                print(f"🚨 ТРИГГЕР: SOS для {user.telegram_id}")
-                user.alert_status = 2
-                await db.commit()
-                await send_telegram_alert(user.telegram_id, "🆘 ТРЕВОГА ОТПРАВЛЕНА!")
+def _schedule_precise(due_at):
+    if due_at is None or scheduler is None or not scheduler.running:
+        return
+    if due_at - datetime.utcnow() >= timedelta(seconds=TICK_SECONDS):
+        return  # обычный тик успеет
+    run_at = due_at.replace(tzinfo=timezone.utc)  # в базе naive UTC
+    job = scheduler.get_job(PRECISE_JOB_ID)
+    if job is not None and job.next_run_time <= run_at:
+        return
+    scheduler.add_job(poll_job, "date", run_date=run_at, id=PRECISE_JOB_ID, replace_existing=True)
+
+async def poll_job():
+    await check_users_job()
+    # Ближайший будущий дедлайн - одно чтение края индекса ix_users_next_due_at
+    async with engine.connect() as db:
+        due_at = (await db.execute(
+            select(func.min(User.next_due_at)).where(User.next_due_at > datetime.utcnow())
+        )).scalar()
+    _schedule_precise(due_at)
 
 async def start_scheduler():
+    global scheduler
+    if scheduler is None:
+        from apscheduler.schedulers.asyncio import AsyncIOScheduler
+        scheduler = AsyncIOScheduler()
     if not scheduler.get_jobs():
-        scheduler.add_job(check_users_job, "interval", seconds=10)
+        scheduler.add_job(poll_job, "interval", seconds=TICK_SECONDS)
     if not scheduler.running:
         scheduler.start()
-        print("⏰ Планировщик запущен.")
\ No newline at end of file
+        log.info("⏰ Планировщик запущен.")
+
+# ДВИЖОК "timer": дедлайны в памяти, без опроса базы
+
+class DeadlineTimer:
+    """Мин-куча дедлайнов. Будит задачу ровно в момент ближайшего дедлайна.
+
+    Из базы читаем только при старте (hydrate), дальше куча обновляется
+    из API через schedule/cancel, а база только пишется при срабатывании.
+    """
+
+    def __init__(self):
+        self._heap = []   # (due_at, telegram_id), старые записи удаляются лениво
+        self._due = {}    # telegram_id -> актуальный дедлайн
+        self._dnd = {}    # telegram_id -> (dnd_start_min, dnd_end_min, timezone)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._due)
+
+    def schedule(self, telegram_id, due_at, dnd=None):
+        if dnd is not None:
+            if dnd[0] is None or dnd[1] is None:
+                self._dnd.pop(telegram_id, None)
+            else:
+                self._dnd[telegram_id] = dnd
+        if due_at is None:
+            return self.cancel(telegram_id)
+        self._due[telegram_id] = due_at
+        heapq.heappush(self._heap, (due_at, telegram_id))
+        self._compact()
+        # Будим цикл, только если новый дедлайн раньше текущего ожидания
+        if self._heap[0] == (due_at, telegram_id):
+            self._wakeup.set()
+
+    def cancel(self, telegram_id):
+        self._due.pop(telegram_id, None)
+
+    def _compact(self):
+        # Чистим кучу от устаревших записей, если их стало слишком много
+        if len(self._heap) > 2 * len(self._due) + 1024:
+            self._heap = [(due, tid) for tid, due in self._due.items()]
+            heapq.heapify(self._heap)
+
+    async def hydrate(self):
+        """Загружает дедлайны из базы (после рестарта ничего не теряется)"""
+        self._heap.clear()
+        self._due.clear()
+        self._dnd.clear()
+        async with engine.connect() as db:
+            result = await db.stream(
+                select(User.telegram_id, User.next_due_at, User.dnd_start_min, User.dnd_end_min, User.timezone)
+                .where(User.next_due_at != None, User.is_active == True)
+            )
+            async for tid, due_at, dnd_start, dnd_end, tz in result:
+                self._due[tid] = due_at
+                if dnd_start is not None:
+                    self._dnd[tid] = (dnd_start, dnd_end, tz)
+        self._heap = [(due, tid) for tid, due in self._due.items()]
+        heapq.heapify(self._heap)
+        log.info("⏰ Таймер: загружено %s дедлайнов", len(self._due))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _pop_due(self, now):
+        fired = []
+        while self._heap and self._heap[0][0] <= now:
+            due_at, tid = heapq.heappop(self._heap)
+            if self._due.get(tid) != due_at:
+                continue  # дедлайн уже передвинули
+            del self._due[tid]
+            dnd = self._dnd.get(tid)
+            if dnd and is_in_dnd(*dnd, now):
+                # Спит - переносим ровно на конец окна сна
+                self.schedule(tid, dnd_end_after(*dnd, now))
+                continue
+            fired.append(tid)
+        return fired
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = datetime.utcnow()
+            fired = self._pop_due(now)
+            if fired:
+                try:
+                    await self._fire(fired, now)
+                except Exception as e:
+                    log.error("❌ Ошибка таймера: %s", e)
+                    # Вернем дедлайны в кучу, попробуем еще раз чуть позже
+                    for tid in fired:
+                        self.schedule(tid, now + timedelta(seconds=5))
+                continue
+
+            timeout = (self._heap[0][0] - now).total_seconds() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, telegram_ids, now):
+        # Только запись: переходы те же, что и у движка "poll"
+        async with engine.connect() as db:
+            warned_rows, reminded_rows, sos_ids = await apply_transitions(db, now, telegram_ids)
+        for row in warned_rows + reminded_rows:
+            self.schedule(row.telegram_id, row.next_due_at)
+        await notify_transitions(warned_rows, reminded_rows, sos_ids)
+
+timers = DeadlineTimer()
+Gauge("scheduler_timer_deadlines", "Дедлайны в куче движка timer", lambda: len(timers))
+
+# ДВИЖОК "partitioned": юзеры поделены на шарды, шарды разбирают воркеры
+
+# Ключи advisory-локов Postgres: членство воркера и аренда шарда
+MEMBER_LOCK_KEY = 71001
+SHARD_LOCK_KEY = 71002
+# Advisory-локи живут в своей базе: воркеры других баз того же Postgres
+# (стенд, lonely_bench) не считаются
+_COUNT_LOCKS = text(
+    "SELECT count(DISTINCT (pid, objid)) FROM pg_locks "
+    "WHERE locktype = 'advisory' AND classid = :key AND granted "
+    "AND database = (SELECT oid FROM pg_database WHERE datname = current_database())"
+)
+
+class ShardLeases:
+    """Аренда шардов через сессионные advisory-локи Postgres.
+
+    Каждый воркер держит отдельное соединение: пока оно живо, его шарды
+    никто не возьмет. Воркер умер - соединение закрылось, локи отпустились,
+    и на следующем rebalance шарды разберут остальные. Число живых воркеров
+    считаем по локам членства, каждый держит примерно SHARD_COUNT / воркеров.
+    """
+
+    def __init__(self):
+        self.worker_id = random.randint(1, 2**31 - 1)
+        self.held = set()
+        self._conn = None
+
+    async def _connection(self):
+        if self._conn is None or self._conn.closed:
+            self.held.clear()
+            self._conn = await engine.connect()
+            await self._conn.execute(
+                text("SELECT pg_advisory_lock(:key, :worker)"),
+                {"key": MEMBER_LOCK_KEY, "worker": self.worker_id},
+            )
+            await self._conn.commit()
+        return self._conn
+
+    async def rebalance(self):
+        """Отдает лишние шарды и добирает свободные до своей доли"""
+        try:
+            conn = await self._connection()
+            workers = (await conn.execute(_COUNT_LOCKS, {"key": MEMBER_LOCK_KEY})).scalar()
+            target = -(-SHARD_COUNT // max(workers, 1))
+
+            released = set(sorted(self.held)[target:])
+            for shard in released:
+                await conn.execute(
+                    text("SELECT pg_advisory_unlock(:key, :shard)"),
+                    {"key": SHARD_LOCK_KEY, "shard": shard},
+                )
+            self.held -= released
+
+            need = target - len(self.held)
+            if need > 0:
+                self.held.update(await self._claim(conn, need, skip=released))
+
+            # Шарды без хозяина никто не проверяет: их юзеры остались бы без SOS.
+            # Отпущенные сейчас оставляем другим воркерам до следующего тика
+            locked = (await conn.execute(_COUNT_LOCKS, {"key": SHARD_LOCK_KEY})).scalar()
+            if locked < SHARD_COUNT:
+                orphans = await self._claim(conn, SHARD_COUNT, skip=released)
+                if orphans:
+                    log.warning("⚠️ Шарды без воркера, забираем себе: %s", sorted(orphans))
+                    self.held.update(orphans)
+            await conn.commit()
+        except Exception as e:
+            log.error("❌ Ошибка аренды шардов: %s", e)
+            await self.close()
+        return sorted(self.held)
+
+    async def _claim(self, conn, limit, skip=()):
+        # Берем свободные шарды в случайном порядке, чтобы воркеры не толкались.
+        # MATERIALIZED: из подзапроса Postgres опустил бы pg_try_advisory_lock под LIMIT
+        # и взял бы все свободные шарды, а вернул бы только limit из них
+        result = await conn.execute(
+            text("WITH free AS MATERIALIZED (SELECT s FROM generate_series(0, :count - 1) AS s "
+                 "WHERE s <> ALL(:skip) ORDER BY random()) "
+                 "SELECT s FROM free WHERE pg_try_advisory_lock(:key, s) LIMIT :limit"),
+            {"count": SHARD_COUNT, "skip": list(self.held | set(skip)), "key": SHARD_LOCK_KEY, "limit": limit},
+        )
+        return set(result.scalars().all())
+
+    async def close(self):
+        """Отпускает все локи. Соединение не возвращаем в пул: сессионные
+        advisory-локи пережили бы возврат и держали бы шарды дальше"""
+        self.held.clear()
+        if self._conn is not None:
+            try:
+                await self._conn.execute(text("SELECT pg_advisory_unlock_all()"))
+                await self._conn.commit()
+            except Exception:
+                pass
+            try:
+                await self._conn.invalidate()
+                await self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+class PartitionedWorker:
+    """Обрабатывает только свои шарды. Аренду обновляет раз в TICK_SECONDS,
+    а между тиками спит до ближайшего дедлайна своих шардов (не дольше
+    TICK_SECONDS): напоминания и SOS уходят вовремя, а не с точностью до тика"""
+
+    def __init__(self):
+        self.leases = ShardLeases()
+        self._task = None
+        self._shards = []
+        self._rebalanced_at = None
+        self._wakeup = asyncio.Event()
+        self._wake_at = None  # когда (UTC) проснемся сами
+
+    async def tick(self):
+        """Возвращает ближайший будущий дедлайн своих шардов (или None)"""
+        now = asyncio.get_running_loop().time()
+        if self._rebalanced_at is None or now - self._rebalanced_at >= TICK_SECONDS:
+            self._shards = await self.leases.rebalance()
+            self._rebalanced_at = now
+        if not self._shards:
+            return None
+        await check_users_job(shards=self._shards)
+        async with engine.connect() as db:
+            return (await db.execute(
+                select(func.min(User.next_due_at)).where(
+                    User.next_due_at > datetime.utcnow(), any_of(User.telegram_id % SHARD_COUNT, self._shards)
+                )
+            )).scalar()
+
+    def notify(self, due_at):
+        """Дедлайн поменяли в API этого процесса: будим, если он раньше нашего пробуждения"""
+        if self._wake_at is not None and due_at is not None and due_at < self._wake_at:
+            self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            self._wakeup.clear()
+            due_at = None
+            try:
+                due_at = await self.tick()
+            except Exception as e:
+                log.error("❌ Ошибка тика: %s", e)
+            timeout = max(0.0, TICK_SECONDS - (loop.time() - started))
+            if due_at is not None:
+                timeout = min(timeout, max(0.0, (due_at - datetime.utcnow()).total_seconds()))
+            self._wake_at = datetime.utcnow() + timedelta(seconds=timeout)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            log.info("⏰ Воркер %s запущен (%s шардов).", self.leases.worker_id, SHARD_COUNT)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.leases.close()
+
+partitioned = PartitionedWorker()
+Gauge("scheduler_shards_held", "Шарды, арендованные этим процессом", lambda: len(partitioned.leases.held))
+
+def notify_deadline(telegram_id, due_at, dnd=None):
+    """Вызывается из API после изменения дедлайна юзера"""
+    if SCHEDULER_ENGINE == "timer":
+        timers.schedule(telegram_id, due_at, dnd)
+    elif SCHEDULER_ENGINE == "poll":
+        _schedule_precise(due_at)
+    elif SCHEDULER_ENGINE == "partitioned":
+        partitioned.notify(due_at)
+
+async def start_engine():
+    if SCHEDULER_ENGINE == "timer":
+        await timers.hydrate()
+        timers.start()
+        log.info("⏰ Таймер дедлайнов запущен.")
+    elif SCHEDULER_ENGINE == "partitioned":
+        partitioned.start()
+    elif SCHEDULER_ENGINE == "off":
+        log.info("⏰ Планировщик в этом процессе выключен (SCHEDULER_ENGINE=off).")
+    else:
+        await start_scheduler()
+
+async def stop_engine():
+    if SCHEDULER_ENGINE == "timer":
+        await timers.stop()
+    elif SCHEDULER_ENGINE == "partitioned":
+        await partitioned.stop()
+    elif scheduler is not None and scheduler.running:
+        scheduler.shutdown(wait=False)
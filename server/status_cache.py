@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import logging
+from collections import OrderedDict
+
+from metrics import Counter, Gauge
+
+# Кэш ответов /status: 0 - выключен
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", "60"))
+STATUS_CACHE_SIZE = int(os.getenv("STATUS_CACHE_SIZE", "10000"))
+# "memory" - свой кэш в каждом процессе, "redis" - общий для всех реплик API
+STATUS_CACHE_BACKEND = os.getenv("STATUS_CACHE_BACKEND", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+log = logging.getLogger("status_cache")
+
+LOOKUPS = Counter("status_cache_total", "Обращения к кэшу /status", ["result"])
+
+
+class MemoryBackend:
+    """LRU с TTL в памяти процесса.
+
+    Версия юзера растет при каждой инвалидации; профиль кладется, только если
+    версия не изменилась с начала чтения. Версии тоже ограничены по размеру:
+    вытесненная версия поднимает общий нижний порог, поэтому забытый юзер
+    не вернется к старой версии (в худшем случае лишний промах)."""
+
+    def __init__(self, ttl, size):
+        self.ttl, self.size = ttl, size
+        self._data = OrderedDict()  # telegram_id -> (истекает, профиль)
+        self._versions = OrderedDict()  # telegram_id -> версия
+        self._clock = 0
+        self._floor = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _version(self, telegram_id):
+        return self._versions.get(telegram_id, self._floor)
+
+    async def get(self, telegram_id):
+        version = self._version(telegram_id)
+        entry = self._data.get(telegram_id)
+        if entry is None:
+            return None, version
+        if entry[0] <= time.monotonic():
+            del self._data[telegram_id]
+            return None, version
+        self._data.move_to_end(telegram_id)
+        return entry[1], version
+
+    async def set(self, telegram_id, value, version):
+        if self._version(telegram_id) != version:
+            return
+        self._data[telegram_id] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(telegram_id)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    async def invalidate(self, telegram_ids):
+        for tid in telegram_ids:
+            self._data.pop(tid, None)
+            self._clock += 1
+            self._versions[tid] = self._clock
+            self._versions.move_to_end(tid)
+        while len(self._versions) > self.size:
+            _, version = self._versions.popitem(last=False)
+            self._floor = max(self._floor, version)
+
+
+# Кладет профиль, только если версия юзера не изменилась с начала чтения
+_SET_IF_VERSION = """
+if (redis.call('get', KEYS[2]) or '0') == ARGV[1] then
+    redis.call('set', KEYS[1], ARGV[2], 'PX', ARGV[3])
+end
+"""
+
+
+class RedisBackend:
+    """Общий кэш для нескольких реплик: инвалидация с любой реплики видна всем.
+    Версии юзеров тоже в Redis (INCR), поэтому запись на одной реплике
+    не даст другой положить прочитанный до нее профиль"""
+
+    # Версия живет дольше любого чтения из базы
+    VERSION_TTL_MS = 24 * 3600 * 1000
+
+    def __init__(self, ttl, url):
+        # Импорт тут: redis нужен только этому бэкенду
+        import redis.asyncio as redis
+        self.ttl = ttl
+        self._redis = redis.from_url(url)
+        self._set_if_version = self._redis.register_script(_SET_IF_VERSION)
+
+    def __len__(self):
+        return 0
+
+    @staticmethod
+    def _key(telegram_id):
+        return f"status:{telegram_id}"
+
+    @staticmethod
+    def _version_key(telegram_id):
+        return f"status:v:{telegram_id}"
+
+    async def get(self, telegram_id):
+        raw, version = await self._redis.mget(self._key(telegram_id), self._version_key(telegram_id))
+        return (json.loads(raw) if raw is not None else None), (version or b"0").decode()
+
+    async def set(self, telegram_id, value, version):
+        await self._set_if_version(
+            keys=[self._key(telegram_id), self._version_key(telegram_id)],
+            args=[version, json.dumps(value, ensure_ascii=False), int(self.ttl * 1000)],
+        )
+
+    async def invalidate(self, telegram_ids):
+        if not telegram_ids:
+            return
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(*(self._key(tid) for tid in telegram_ids))
+            for tid in telegram_ids:
+                pipe.incr(self._version_key(tid))
+                pipe.pexpire(self._version_key(tid), self.VERSION_TTL_MS)
+            await pipe.execute()
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+class StatusCache:
+    """Read-through кэш профилей для /status.
+
+    Любой эндпоинт, меняющий юзера, вызывает invalidate. Чтобы запрос,
+    начавший читать базу до записи, не положил в кэш старый профиль,
+    get отдает версию юзера, а put кладет ответ, только если она не
+    изменилась. Запись другого юзера чужие чтения не отменяет.
+    Ошибки бэкенда не ломают /status: считаем это промахом.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def __len__(self):
+        return len(self.backend) if self.backend is not None else 0
+
+    async def get(self, telegram_id):
+        """(профиль или None, версия для put)"""
+        if self.backend is None:
+            return None, None
+        try:
+            value, version = await self.backend.get(telegram_id)
+        except Exception as e:
+            log.warning("Кэш /status недоступен: %s", e)
+            value, version = None, None
+        LOOKUPS.inc("hit" if value is not None else "miss")
+        return value, version
+
+    async def put(self, telegram_id, value, version):
+        if self.backend is None or version is None:
+            return
+        try:
+            await self.backend.set(telegram_id, value, version)
+        except Exception as e:
+            log.warning("Кэш /status недоступен: %s", e)
+
+    async def invalidate(self, *telegram_ids):
+        if self.backend is None:
+            return
+        try:
+            await self.backend.invalidate(telegram_ids)
+        except Exception as e:
+            log.warning("Кэш /status недоступен: %s", e)
+
+    async def close(self):
+        if hasattr(self.backend, "close"):
+            await self.backend.close()
+
+
+def build_status_cache():
+    if STATUS_CACHE_TTL <= 0:
+        return StatusCache(None)
+    if STATUS_CACHE_BACKEND == "redis":
+        return StatusCache(RedisBackend(STATUS_CACHE_TTL, REDIS_URL))
+    return StatusCache(MemoryBackend(STATUS_CACHE_TTL, STATUS_CACHE_SIZE))
+
+
+status_cache = build_status_cache()
+Gauge("status_cache_entries", "Профили в кэше /status этого процесса", lambda: len(status_cache))
@@ -0,0 +1,243 @@
+import os
+import ssl
+import time
+import asyncio
+import logging
+import httpx
+from dotenv import load_dotenv
+
+from metrics import Histogram, TELEGRAM_SEND_SECONDS, TELEGRAM_MESSAGES
+
+load_dotenv()
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+
+# Сколько параллельных отправителей
+SENDERS = int(os.getenv("TELEGRAM_SENDERS", "8"))
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))
+QUEUE_SIZE = int(os.getenv("TELEGRAM_QUEUE_SIZE", "100000"))
+
+log = logging.getLogger("telegram")
+DELIVERY_SECONDS = Histogram("telegram_delivery_seconds", "От постановки в очередь до ответа Telegram",
+                             buckets=(0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300))
+
+
+def _ssl_context():
+    import certifi
+    return ssl.create_default_context(cafile=certifi.where())
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Message:
+    __slots__ = ("chat_id", "payload", "attempts", "enqueued_at", "result")
+
+    def __init__(self, chat_id, payload, result=None):
+        self.chat_id = chat_id
+        self.payload = payload
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+        self.result = result  # Future с итогом отправки, если отправитель его ждет
+
+    def finish(self, outcome):
+        if self.result is not None and not self.result.done():
+            self.result.set_result(outcome)
+
+
+class TelegramDispatcher:
+    """Очередь исходящих сообщений с общим пулом соединений.
+
+    SENDERS воркеров разбирают очередь, общий лимит держит TokenBucket,
+    лимит на чат - время следующей разрешенной отправки в этот чат.
+    На 429 ждем retry_after, на сетевые ошибки и 5xx - экспоненциальный бэкофф.
+    """
+
+    def __init__(self):
+        self._queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self._bucket = TokenBucket(GLOBAL_RATE)
+        self._chat_next = {}      # chat_id -> когда можно писать в чат снова
+        self._paused_until = 0.0  # глобальная пауза после 429
+        self._client = None
+        self._workers = []
+        self._pending = 0         # сообщения, отложенные на повтор
+        self._requeues = set()    # возвраты в переполненную очередь
+
+    async def start(self):
+        if self._client is not None:
+            return
+        # Загрузка корневых сертификатов - ~0.2 с CPU: делаем в потоке,
+        # чтобы на старте она шла параллельно с init_db
+        verify = await asyncio.to_thread(_ssl_context)
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            base_url=f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}",
+            timeout=10.0,
+            verify=verify,
+            limits=httpx.Limits(max_connections=SENDERS, max_keepalive_connections=SENDERS),
+        )
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(SENDERS)]
+        log.info("📨 Диспетчер Telegram запущен (%s отправителей)", SENDERS)
+
+    async def stop(self, timeout=5.0):
+        if self._client is None:
+            return
+        # Даем очереди немного времени досохнуть
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("⚠️ Диспетчер остановлен, в очереди осталось %s сообщений", self._queue.qsize())
+        for task in self._workers + list(self._requeues):
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._requeues, return_exceptions=True)
+        self._workers = []
+        await self._client.aclose()
+        self._client = None
+
+    async def drain(self):
+        """Ждет, пока уйдут все сообщения, включая отложенные на повтор"""
+        while True:
+            await self._queue.join()
+            if not self._pending:
+                return
+            await asyncio.sleep(0.05)
+
+    async def send(self, chat_id, text, reply_markup=None, wait=False):
+        """Ставит сообщение в очередь. Ждет, только если очередь переполнена.
+        wait=True - дождаться итога с повторами ("sent", "rejected" или "failed")"""
+        if self._client is None:
+            await self.start()
+        payload = {"chat_id": chat_id, "text": text}
+        if reply_markup is not None:
+            payload["reply_markup"] = reply_markup
+        result = asyncio.get_running_loop().create_future() if wait else None
+        await self._queue.put(Message(chat_id, payload, result))
+        if result is not None:
+            return await result
+
+    def queue_depth(self):
+        return self._queue.qsize() + self._pending
+
+    def _retry_later(self, msg, delay, retry=True):
+        """Вернет сообщение в очередь через delay секунд.
+        retry=False - не повтор, а ожидание лимита чата: в метрику повторов не идет"""
+        if retry:
+            TELEGRAM_MESSAGES.inc("retried")
+        self._pending += 1
+        asyncio.get_running_loop().call_later(delay, self._put_back, msg)
+
+    def _put_back(self, msg):
+        try:
+            self._queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            # Очередь полна: ждем места в задаче, сообщение не теряем
+            task = asyncio.create_task(self._queue.put(msg))
+            self._requeues.add(task)
+            task.add_done_callback(lambda t: self._requeued(msg, t))
+            return
+        self._pending -= 1
+
+    def _requeued(self, msg, task):
+        self._requeues.discard(task)
+        self._pending -= 1
+        if task.cancelled() or task.exception() is not None:
+            TELEGRAM_MESSAGES.inc("failed")
+            msg.finish("failed")
+
+    async def _worker(self):
+        while True:
+            msg = await self._queue.get()
+            try:
+                await self._deliver(msg)
+            except Exception as e:
+                TELEGRAM_MESSAGES.inc("failed")
+                log.error("❌ Ошибка отправки в %s: %s", msg.chat_id, e)
+                msg.finish("failed")
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, msg):
+        now = time.monotonic()
+        # Чат еще "остывает" - откладываем, не занимая отправителя
+        wait = self._chat_next.get(msg.chat_id, 0.0) - now
+        if wait > 0:
+            # Слот чата занят другим отправителем (inf) - заглянем через интервал чата
+            return self._retry_later(msg, min(wait, 1 / CHAT_RATE), retry=False)
+        # Занимаем слот чата до первого await: иначе другие отправители, пока
+        # этот ждет паузу или токен, тоже пройдут проверку и напишут в тот же чат
+        self._chat_next[msg.chat_id] = float("inf")
+        try:
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+            await self._bucket.acquire()
+        finally:
+            self._chat_next[msg.chat_id] = time.monotonic() + 1 / CHAT_RATE
+        self._forget_idle_chats()
+
+        msg.attempts += 1
+        started = time.monotonic()
+        try:
+            resp = await self._client.post("/sendMessage", json=msg.payload)
+        except httpx.HTTPError as e:
+            return self._backoff(msg, f"сеть: {e}")
+        TELEGRAM_SEND_SECONDS.observe(time.monotonic() - started)
+
+        if resp.status_code == 429:
+            try:
+                retry_after = resp.json()["parameters"]["retry_after"]
+            except (ValueError, KeyError):
+                retry_after = 1
+            self._paused_until = time.monotonic() + retry_after
+            log.warning("⏳ Telegram просит подождать %sс", retry_after)
+            msg.attempts -= 1  # флуд-контроль не считаем неудачной попыткой
+            return self._retry_later(msg, retry_after)
+        if resp.status_code >= 500:
+            return self._backoff(msg, f"HTTP {resp.status_code}")
+        if resp.status_code != 200:
+            # 400/403 - юзер заблокировал бота и т.п., повторять бессмысленно
+            TELEGRAM_MESSAGES.inc("rejected")
+            log.warning("❌ Telegram отклонил сообщение для %s: %s %s", msg.chat_id, resp.status_code, resp.text)
+            return msg.finish("rejected")
+
+        TELEGRAM_MESSAGES.inc("sent")
+        DELIVERY_SECONDS.observe(time.monotonic() - msg.enqueued_at)
+        msg.finish("sent")
+
+    def _backoff(self, msg, reason):
+        if msg.attempts >= MAX_RETRIES:
+            TELEGRAM_MESSAGES.inc("failed")
+            log.error("❌ Не удалось отправить %s после %s попыток (%s)", msg.chat_id, msg.attempts, reason)
+            return msg.finish("failed")
+        self._retry_later(msg, min(2 ** msg.attempts, 60))
+
+    def _forget_idle_chats(self):
+        if len(self._chat_next) > 10000:
+            now = time.monotonic()
+            self._chat_next = {cid: t for cid, t in self._chat_next.items() if t > now}
+
+
+dispatcher = TelegramDispatcher()
@@ -0,0 +1,36 @@
+import asyncio
+import logging
+import signal
+
+from metrics import setup_logging
+from telegram import dispatcher
+from scheduler import partitioned
+from escalation import escalation
+
+log = logging.getLogger("worker")
+
+# Отдельная точка входа планировщика (без API): python worker.py
+# Реплик можно запускать сколько угодно - шарды делятся через advisory-локи.
+# Схему базы создает API (server), поэтому воркер стартует после него.
+
+async def main():
+    setup_logging()
+    log.info("🚀 Воркер планировщика запускается...")
+    await dispatcher.start()
+    partitioned.start()
+    escalation.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    log.info("🛑 Остановка воркера...")
+    await partitioned.stop()
+    await escalation.stop()
+    await dispatcher.stop()
+    log.info("🛑 Воркер остановлен")
+
+if __name__ == "__main__":
+    asyncio.run(main())
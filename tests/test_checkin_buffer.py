@@ -0,0 +1,125 @@
+"""Буфер чекинов: запись в базу подменяется, проверяются инварианты буфера."""
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+import pytest
+
+import checkins
+from checkins import CheckinBuffer
+
+T0 = datetime(2026, 1, 1, 12, 0)
+
+
+class FakeDb:
+    async def commit(self):
+        pass
+
+
+class FakeEngine:
+    @asynccontextmanager
+    async def connect(self):
+        yield FakeDb()
+
+
+class Writes(list):
+    """Пачки, переданные в checkin_users. gate - пауза посреди записи, error - падение записи"""
+    gate = None
+    error = None
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    calls = Writes()
+
+    async def fake_checkin_users(db, ids, now):
+        calls.append((sorted(ids), now))
+        if calls.gate is not None:
+            await calls.gate.wait()
+        if calls.error is not None:
+            raise calls.error
+        return [(tid,) for tid in ids]
+
+    monkeypatch.setattr(checkins, "engine", FakeEngine())
+    monkeypatch.setattr(checkins, "checkin_users", fake_checkin_users)
+    return calls
+
+
+def test_repeats_collapse_to_earliest(writes):
+    buffer = CheckinBuffer(interval_ms=100, max_pending=100)
+    buffer.add(1, T0)
+    buffer.add(1, T0 + timedelta(seconds=1))
+    buffer.add(2, T0 + timedelta(seconds=2))
+    assert len(buffer) == 2
+    assert set(buffer.pending_ids()) == {1, 2}
+
+    flushed = []
+    buffer._on_flush = flushed.append
+    asyncio.run(buffer.flush())
+    # Дедлайн считается от самого раннего чекина пачки
+    assert writes == [([1, 2], T0)]
+    assert flushed == [[(1,), (2,)]]
+    assert len(buffer) == 0
+    assert buffer.pending_ids() == ()
+
+
+def test_max_pending_wakes_flusher(writes):
+    buffer = CheckinBuffer(interval_ms=100, max_pending=2)
+    buffer.add(1, T0)
+    assert not buffer._wakeup.is_set()
+    buffer.add(2, T0)
+    assert buffer._wakeup.is_set()
+
+
+def test_failed_flush_returns_batch(writes):
+    buffer = CheckinBuffer(interval_ms=100, max_pending=100)
+    writes.error = RuntimeError("база недоступна")
+    writes.gate = asyncio.Event()
+
+    async def scenario():
+        buffer.add(1, T0)
+        buffer.add(2, T0)
+        task = asyncio.create_task(buffer.flush())
+        await asyncio.sleep(0)
+        # Пока пачка пишется, юзеры по-прежнему не видны планировщику
+        assert set(buffer.pending_ids()) == {1, 2}
+        buffer.add(2, T0 + timedelta(minutes=1))
+        writes.gate.set()
+        await task
+
+    asyncio.run(scenario())
+    assert set(buffer.pending_ids()) == {1, 2}
+    # Свежий чекин, пришедший во время записи, не затерт старым
+    assert buffer._pending == {1: T0, 2: T0 + timedelta(minutes=1)}
+
+
+def test_discard_pending():
+    buffer = CheckinBuffer(interval_ms=100, max_pending=100)
+    buffer.add(1, T0)
+    buffer.add(2, T0)
+    asyncio.run(buffer.discard(1))
+    assert set(buffer.pending_ids()) == {2}
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_discard_waits_for_inflight_flush(writes, fail):
+    buffer = CheckinBuffer(interval_ms=100, max_pending=100)
+    writes.gate = asyncio.Event()
+    if fail:
+        writes.error = RuntimeError("база недоступна")
+
+    async def scenario():
+        buffer.add(1, T0)
+        flush = asyncio.create_task(buffer.flush())
+        await asyncio.sleep(0)
+        discard = asyncio.create_task(buffer.discard(1))
+        await asyncio.sleep(0.01)
+        # Иначе запись пачки затерла бы статус, выставленный после discard
+        assert not discard.done()
+        writes.gate.set()
+        await flush
+        await asyncio.wait_for(discard, 1)
+
+    asyncio.run(scenario())
+    # И упавшая пачка не возвращает отмененный чекин в буфер
+    assert buffer.pending_ids() == ()
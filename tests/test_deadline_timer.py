@@ -0,0 +1,82 @@
+"""Куча дедлайнов движка timer: без базы, только _pop_due и schedule."""
+from datetime import datetime, timedelta
+
+from scheduler import DeadlineTimer
+
+T0 = datetime(2026, 1, 1, 12, 0)
+
+
+def test_fires_due_deadlines_only():
+    timer = DeadlineTimer()
+    timer.schedule(1, T0)
+    timer.schedule(2, T0 + timedelta(minutes=5))
+    assert timer._pop_due(T0) == [1]
+    assert len(timer) == 1
+    assert timer._pop_due(T0 + timedelta(minutes=5)) == [2]
+    assert len(timer) == 0
+
+
+def test_reschedule_later_drops_old_entry():
+    timer = DeadlineTimer()
+    timer.schedule(1, T0)
+    timer.schedule(1, T0 + timedelta(hours=1))
+    # Старая запись осталась в куче, но уже не актуальна
+    assert timer._pop_due(T0 + timedelta(minutes=1)) == []
+    assert timer._pop_due(T0 + timedelta(hours=1)) == [1]
+
+
+def test_reschedule_earlier_fires_once():
+    timer = DeadlineTimer()
+    timer.schedule(1, T0 + timedelta(hours=1))
+    timer.schedule(1, T0)
+    assert timer._pop_due(T0) == [1]
+    assert timer._pop_due(T0 + timedelta(hours=1)) == []
+
+
+def test_cancel_and_none_deadline():
+    timer = DeadlineTimer()
+    timer.schedule(1, T0)
+    timer.schedule(2, T0)
+    timer.cancel(1)
+    timer.schedule(2, None)
+    assert timer._pop_due(T0 + timedelta(days=1)) == []
+    assert len(timer) == 0
+
+
+def test_wakes_loop_only_for_new_earliest():
+    timer = DeadlineTimer()
+    timer.schedule(1, T0)
+    timer._wakeup.clear()
+    timer.schedule(2, T0 + timedelta(hours=1))
+    assert not timer._wakeup.is_set()
+    timer.schedule(3, T0 - timedelta(hours=1))
+    assert timer._wakeup.is_set()
+
+
+def test_compaction_bounds_heap():
+    timer = DeadlineTimer()
+    for i in range(5000):
+        timer.schedule(1, T0 + timedelta(seconds=i))
+    assert len(timer) == 1
+    assert len(timer._heap) <= 2 * len(timer) + 1024 + 1
+    assert timer._pop_due(T0 + timedelta(seconds=4998)) == []
+    assert timer._pop_due(T0 + timedelta(seconds=4999)) == [1]
+
+
+def test_sleeping_user_moved_to_end_of_dnd():
+    timer = DeadlineTimer()
+    # Сон 22:00-06:00 по Москве (UTC+3); 20:00 UTC = 23:00 MSK
+    now = datetime(2026, 1, 1, 20, 0)
+    timer.schedule(1, now, (22 * 60, 6 * 60, "Europe/Moscow"))
+    assert timer._pop_due(now) == []
+    # 06:00 MSK включительно - еще сон, будим в 06:01 MSK = 03:01 UTC
+    assert timer._due[1] == datetime(2026, 1, 2, 3, 1)
+    assert timer._pop_due(datetime(2026, 1, 2, 3, 1)) == [1]
+
+
+def test_clearing_dnd_fires_normally():
+    timer = DeadlineTimer()
+    now = datetime(2026, 1, 1, 20, 0)
+    timer.schedule(1, now, (22 * 60, 6 * 60, "Europe/Moscow"))
+    timer.schedule(1, now, (None, None, "Europe/Moscow"))
+    assert timer._pop_due(now) == [1]
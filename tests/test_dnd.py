@@ -0,0 +1,75 @@
+"""Окно сна и часовые пояса (server/dnd.py)."""
+from datetime import datetime
+
+import pytest
+
+from dnd import dnd_end_after, in_window, is_in_dnd, normalize_timezone, parse_hhmm
+
+
+def test_parse_hhmm():
+    assert parse_hhmm("00:00") == 0
+    assert parse_hhmm(" 23:30 ") == 23 * 60 + 30
+    with pytest.raises(ValueError):
+        parse_hhmm("24:00")
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("+3", "Etc/GMT-3"),
+    ("UTC+3", "Etc/GMT-3"),
+    ("GMT -5", "Etc/GMT+5"),
+    ("-12", "Etc/GMT+12"),
+    ("+0", "UTC"),
+    ("Europe/Moscow", "Europe/Moscow"),
+    (" Asia/Tokyo ", "Asia/Tokyo"),
+])
+def test_normalize_timezone(value, expected):
+    assert normalize_timezone(value) == expected
+
+
+@pytest.mark.parametrize("value", ["Europe", "Mars/Olympus", "+15", "3", "", "../etc/passwd"])
+def test_normalize_timezone_rejects_unknown(value):
+    with pytest.raises(ValueError):
+        normalize_timezone(value)
+
+
+def test_window_inside_day():
+    # 13:00-15:00
+    assert in_window(13 * 60, 13 * 60, 15 * 60)
+    assert in_window(15 * 60, 13 * 60, 15 * 60)
+    assert not in_window(15 * 60 + 1, 13 * 60, 15 * 60)
+    assert not in_window(12 * 60, 13 * 60, 15 * 60)
+
+
+def test_window_wraps_midnight():
+    # 23:00-06:00
+    start, end = 23 * 60, 6 * 60
+    assert in_window(23 * 60, start, end)
+    assert in_window(0, start, end)
+    assert in_window(6 * 60, start, end)
+    assert not in_window(6 * 60 + 1, start, end)
+    assert not in_window(12 * 60, start, end)
+
+
+def test_no_window():
+    assert not in_window(0, None, 6 * 60)
+    assert not is_in_dnd(None, None, "UTC", datetime(2026, 1, 1))
+
+
+def test_is_in_dnd_uses_user_timezone():
+    # 20:30 UTC = 23:30 в Москве
+    now = datetime(2026, 1, 1, 20, 30)
+    assert is_in_dnd(23 * 60, 6 * 60, "Europe/Moscow", now)
+    assert not is_in_dnd(23 * 60, 6 * 60, "UTC", now)
+    assert is_in_dnd(23 * 60, 6 * 60, "Etc/GMT-3", now)
+
+
+def test_dnd_end_after_wraps_midnight():
+    # 23:30:15 MSK, сон до 06:00 включительно - будим в 06:01 MSK
+    now = datetime(2026, 1, 1, 20, 30, 15)
+    assert dnd_end_after(23 * 60, 6 * 60, "Europe/Moscow", now) == datetime(2026, 1, 2, 3, 1)
+
+
+def test_dnd_end_after_last_minute():
+    now = datetime(2026, 1, 1, 6, 0, 59)
+    assert dnd_end_after(23 * 60, 6 * 60, "UTC", now) == datetime(2026, 1, 1, 6, 1)
+    assert not is_in_dnd(23 * 60, 6 * 60, "UTC", datetime(2026, 1, 1, 6, 1))
@@ -0,0 +1,146 @@
+"""Кэш /status: версии против гонки чтения и записи, LRU и TTL (бэкенд в памяти)."""
+import asyncio
+
+import status_cache as sc
+from status_cache import MemoryBackend, StatusCache
+
+
+def memory_cache(ttl=60, size=100):
+    return StatusCache(MemoryBackend(ttl, size))
+
+
+def test_hit_after_put():
+    cache = memory_cache()
+
+    async def scenario():
+        assert (await cache.get(1))[0] is None
+        _, version = await cache.get(1)
+        await cache.put(1, {"status": 0}, version)
+        return await cache.get(1)
+
+    value, _ = asyncio.run(scenario())
+    assert value == {"status": 0}
+
+
+def test_own_invalidation_blocks_stale_put():
+    cache = memory_cache()
+
+    async def scenario():
+        _, version = await cache.get(1)  # запрос начал читать базу
+        await cache.invalidate(1)        # тем временем юзер записан
+        await cache.put(1, {"status": 0}, version)
+        return await cache.get(1)
+
+    value, _ = asyncio.run(scenario())
+    assert value is None
+
+
+def test_other_user_invalidation_does_not_block_put():
+    cache = memory_cache()
+
+    async def scenario():
+        _, version = await cache.get(1)
+        await cache.invalidate(2, 3)
+        await cache.put(1, {"status": 0}, version)
+        return await cache.get(1)
+
+    value, _ = asyncio.run(scenario())
+    assert value == {"status": 0}
+
+
+def test_invalidate_drops_entry():
+    cache = memory_cache()
+
+    async def scenario():
+        _, version = await cache.get(1)
+        await cache.put(1, {"status": 0}, version)
+        await cache.invalidate(1)
+        value, version = await cache.get(1)
+        assert value is None
+        # После инвалидации новый профиль снова кладется
+        await cache.put(1, {"status": 2}, version)
+        return await cache.get(1)
+
+    value, _ = asyncio.run(scenario())
+    assert value == {"status": 2}
+
+
+def test_evicted_version_does_not_come_back():
+    cache = memory_cache(size=2)
+
+    async def scenario():
+        _, version = await cache.get(1)
+        await cache.invalidate(1)
+        # Версия юзера 1 вытеснена, но порог не дает вернуться к старой
+        await cache.invalidate(2, 3)
+        assert 1 not in cache.backend._versions
+        await cache.put(1, {"status": 0}, version)
+        return await cache.get(1)
+
+    value, _ = asyncio.run(scenario())
+    assert value is None
+
+
+def test_lru_size_limit():
+    cache = memory_cache(size=2)
+
+    async def scenario():
+        for tid in (1, 2):
+            _, version = await cache.get(tid)
+            await cache.put(tid, {"id": tid}, version)
+        await cache.get(1)  # 1 свежее, вытеснится 2
+        _, version = await cache.get(3)
+        await cache.put(3, {"id": 3}, version)
+        return [(await cache.get(tid))[0] for tid in (1, 2, 3)]
+
+    assert asyncio.run(scenario()) == [{"id": 1}, None, {"id": 3}]
+    assert len(cache) == 2
+
+
+def test_ttl_expiry(monkeypatch):
+    cache = memory_cache(ttl=60)
+    clock = [1000.0]
+    monkeypatch.setattr(sc.time, "monotonic", lambda: clock[0])
+
+    async def scenario():
+        _, version = await cache.get(1)
+        await cache.put(1, {"status": 0}, version)
+        clock[0] += 59
+        assert (await cache.get(1))[0] == {"status": 0}
+        clock[0] += 1
+        return await cache.get(1)
+
+    value, _ = asyncio.run(scenario())
+    assert value is None
+    assert len(cache) == 0
+
+
+class BrokenBackend:
+    async def get(self, *args):
+        raise ConnectionError("redis недоступен")
+
+    set = invalidate = get
+
+
+def test_backend_errors_are_misses():
+    cache = StatusCache(BrokenBackend())
+
+    async def scenario():
+        value, version = await cache.get(1)
+        assert (value, version) == (None, None)
+        await cache.put(1, {"status": 0}, version)
+        await cache.invalidate(1)
+
+    asyncio.run(scenario())
+
+
+def test_disabled_cache():
+    cache = StatusCache(None)
+    assert not cache.enabled
+
+    async def scenario():
+        await cache.put(1, {"status": 0}, 0)
+        await cache.invalidate(1)
+        return await cache.get(1)
+
+    assert asyncio.run(scenario()) == (None, None)
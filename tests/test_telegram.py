@@ -0,0 +1,157 @@
+"""Диспетчер Telegram: Bot API подменяется httpx.MockTransport."""
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import telegram
+from telegram import Message, TelegramDispatcher, TokenBucket
+
+
+def make_dispatcher(handler, senders=4, rate=1000, queue_size=100):
+    """Диспетчер без сети: handler(request) -> httpx.Response. Вызывать внутри цикла"""
+    d = TelegramDispatcher()
+    d._queue = asyncio.Queue(maxsize=queue_size)
+    d._bucket = TokenBucket(rate)
+    d._client = httpx.AsyncClient(base_url="http://telegram.test/botTOKEN", transport=httpx.MockTransport(handler))
+    d._workers = [asyncio.create_task(d._worker()) for _ in range(senders)]
+    return d
+
+
+def recorder(responses=()):
+    """Обработчик, который пишет (время, chat_id) и отвечает по очереди из responses, потом 200"""
+    calls = []
+    responses = list(responses)
+
+    def handler(request):
+        calls.append((time.monotonic(), json.loads(request.content)["chat_id"]))
+        if responses:
+            return responses.pop(0)
+        return httpx.Response(200, json={"ok": True})
+
+    return calls, handler
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=1)
+
+    async def scenario():
+        started = time.monotonic()
+        for _ in range(11):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # Первый токен есть сразу, остальные 10 - по 20 мс
+    assert asyncio.run(scenario()) >= 0.19
+
+
+def test_chat_limit_holds_while_senders_wait_for_tokens(monkeypatch):
+    monkeypatch.setattr(telegram, "CHAT_RATE", 10)
+    calls, handler = recorder()
+
+    async def scenario():
+        d = make_dispatcher(handler, senders=4, rate=40)
+        d._bucket.tokens = 0  # все отправители ждут токен одновременно
+        results = await asyncio.gather(*(d.send(42, f"#{i}", wait=True) for i in range(4)))
+        await d.stop()
+        return results
+
+    assert asyncio.run(scenario()) == ["sent"] * 4
+    times = [t for t, _ in calls]
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert len(calls) == 4
+    assert min(gaps) >= 0.1 - 0.01
+
+
+def test_chat_limit_does_not_block_other_chats(monkeypatch):
+    monkeypatch.setattr(telegram, "CHAT_RATE", 1)
+    calls, handler = recorder()
+
+    async def scenario():
+        d = make_dispatcher(handler)
+        started = time.monotonic()
+        await asyncio.gather(*(d.send(chat, "hi", wait=True) for chat in range(1, 9)))
+        await d.stop()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 0.5
+    assert sorted(chat for _, chat in calls) == list(range(1, 9))
+
+
+def test_flood_control_waits_retry_after():
+    calls, handler = recorder([
+        httpx.Response(429, json={"ok": False, "parameters": {"retry_after": 0.2}}),
+    ])
+
+    async def scenario():
+        d = make_dispatcher(handler, senders=1)
+        result = await d.send(42, "hi", wait=True)
+        await d.stop()
+        return result
+
+    assert asyncio.run(scenario()) == "sent"
+    assert len(calls) == 2
+    assert calls[1][0] - calls[0][0] >= 0.2 - 0.01
+
+
+def test_rejected_is_not_retried():
+    calls, handler = recorder([httpx.Response(403, json={"ok": False, "description": "bot was blocked"})])
+
+    async def scenario():
+        d = make_dispatcher(handler, senders=1)
+        result = await d.send(42, "hi", wait=True)
+        await d.stop()
+        return result
+
+    assert asyncio.run(scenario()) == "rejected"
+    assert len(calls) == 1
+
+
+def test_server_errors_fail_after_max_retries(monkeypatch):
+    monkeypatch.setattr(telegram, "MAX_RETRIES", 2)
+    calls, handler = recorder([httpx.Response(502)] * 2)
+    # Бэкофф 2 ** attempts секунд - в тесте без пауз
+    retry_later = TelegramDispatcher._retry_later
+    monkeypatch.setattr(TelegramDispatcher, "_retry_later",
+                        lambda self, msg, delay, retry=True: retry_later(self, msg, 0, retry))
+
+    async def scenario():
+        d = make_dispatcher(handler, senders=1)
+        result = await d.send(42, "hi", wait=True)
+        await d.stop()
+        return result
+
+    assert asyncio.run(scenario()) == "failed"
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("stopped", [False, True])
+def test_retry_into_full_queue_is_not_lost(stopped):
+    async def scenario():
+        d = TelegramDispatcher()
+        d._queue = asyncio.Queue(maxsize=1)
+        d._client = httpx.AsyncClient(transport=httpx.MockTransport(lambda r: httpx.Response(200)))
+        filler = Message(1, {})
+        d._queue.put_nowait(filler)
+        msg = Message(2, {}, asyncio.get_running_loop().create_future())
+
+        d._retry_later(msg, 0)
+        await asyncio.sleep(0.01)
+        # Очередь полна: сообщение ждет места, но учтено в глубине очереди
+        assert len(d._requeues) == 1
+        assert d.queue_depth() == 2
+
+        if stopped:
+            await d.stop(timeout=0)
+            return msg.result.result(), d.queue_depth()
+        assert d._queue.get_nowait() is filler
+        await asyncio.sleep(0.01)
+        assert d._queue.get_nowait() is msg
+        return msg.result.done(), d.queue_depth()
+
+    outcome, depth = asyncio.run(scenario())
+    # Остановка диспетчера не оставляет отправителя ждать вечно
+    assert outcome == ("failed" if stopped else False)
+    assert depth == (1 if stopped else 0)